@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+
+"""
+Replays scripted scenarios against the whole component graph running
+on simulated hardware (see simulator.py) and reports frames/s, SPI
+bytes, end-to-end latency and CPU time per thread.
+
+    python3 benchmark.py [-v] [scenario ...]
+
+BENCH_BAUDRATE=<Hz> sets the SPI clock the transfer times are estimated for.
+The exit status is 1 if a scenario fails its checks (see CHECKS).
+
+The micro benchmarks run without starting the components: "partial"
+compares the SPI bytes per frame with and without partial updates,
+"rgb565" the frame to RGB565 conversion paths and "wallpaper" scaling
+a big wallpaper on every frame with scaling it once.
+"""
+
+import os
+import sys
+import time
+import types
+import random
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+
+import memstats
+import simulator
+from display import DisplayDriver
+from main import Controller, start_display, start_gpio, start_mqtt
+from messagebus import messagebus
+
+TOPIC = "mludvig/coming"
+IDLE_AFTER = 1.0        # Seconds without frames before a scenario is considered done
+SETTLE_TIMEOUT = 30     # Seconds
+BURST_MESSAGES = 2000
+BURST_CPU_LIMIT = 1.0   # Seconds of CPU the whole burst may take
+DOWNLOAD_IMAGE_SIZE = (1920, 1280)
+RSS_SAMPLE_INTERVAL = 0.002     # Seconds
+
+class Bench:
+    """
+    The running component graph plus the frame timestamps seen on the panel
+    """
+    baudrate = int(os.environ.get('BENCH_BAUDRATE', DisplayDriver.BAUDRATE))
+
+    def __init__(self, wallpaper_dir, overrides={}):
+        """
+        overrides: config sections to merge over the defaults below
+        """
+        config = {
+            'MQTT': {'server': "fake", 'topic': TOPIC},
+            'Display': {'backend': "framebuffer", 'baudrate': self.baudrate},
+            'WallpaperStore': {'path': wallpaper_dir},
+            'Snapshot': {'enabled': False},
+            'UnsplashImageDownloader': {'enabled': False, 'url': "", 'api_key': ""},
+            'Buzzer': {'enabled': False},
+        }
+        for section, values in overrides.items():
+            config.setdefault(section, {}).update(values)
+        simulator.use_mock_gpio()
+        self.broker = simulator.FakeBroker()
+        self.controller = Controller(messagebus)
+        self.mqtt = start_mqtt(config, simulator.FakeClient(self.broker, "benchmark"))
+        displays, self.image_downloader = start_display(config)
+        self.display = displays[0]
+        self.controller.preload_display()
+        self.blinker, self.button, self.buzzer = start_gpio(config)
+        self.mqtt.connect()
+
+        self.driver = self.display.driver
+        self.frame_times = []
+        self._lock = threading.Lock()
+        self.driver.on_frame = self.on_frame
+
+    def on_frame(self):
+        with self._lock:
+            self.frame_times.append(time.monotonic())
+
+    def last_frame(self):
+        with self._lock:
+            return self.frame_times[-1] if self.frame_times else 0
+
+    def busy(self):
+        return any(s['queue_depth'] for s in messagebus.stats()) or self.mqtt.publisher.stats()['pending']
+
+    def settle(self, since):
+        # Wait until the frames stop coming and all the queues are drained
+        deadline = time.monotonic() + SETTLE_TIMEOUT
+        while time.monotonic() < deadline:
+            now = time.monotonic()
+            if now - max(since, self.last_frame()) > IDLE_AFTER and not self.busy():
+                return
+            time.sleep(0.05)
+
+def thread_cpu():
+    """
+    CPU seconds used by each live thread, by thread name
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    names = {t.native_id: t.name for t in threading.enumerate()}
+    result = {}
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open(f'/proc/self/task/{tid}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        name = names.get(int(tid), f"tid-{tid}")
+        result[name] = result.get(name, 0) + (int(fields[11]) + int(fields[12])) / ticks
+    return result
+
+class PeakRSS:
+    """
+    How far RSS rises above where it was at the start of the with block,
+    sampled from a thread of its own
+    """
+    def __enter__(self):
+        self.start, _ = memstats.rss()
+        self.rise = 0
+        self._done = threading.Event()
+        self._sampler = threading.Thread(name="PeakRSS", target=self.sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._sampler.join()
+
+    def sample(self):
+        while True:
+            self.rise = max(self.rise, memstats.rss()[0] - self.start)
+            if self._done.wait(RSS_SAMPLE_INTERVAL):
+                return
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Scenarios return the timestamps of the events that should each produce a frame,
+# optionally with a dict of their own numbers for the report and the checks
+
+def scenario_idle(bench):
+    time.sleep(10)
+    return []
+
+def scenario_mqtt_single(bench):
+    events = []
+    for i in range(10):
+        events.append(time.monotonic())
+        bench.broker.publish(TOPIC, "yes" if i % 2 else "no", qos=1, retain=True)
+        time.sleep(1)
+    return events
+
+def scenario_mqtt_burst(bench):
+    events = [time.monotonic()]
+    for i in range(BURST_MESSAGES):
+        bench.broker.publish(TOPIC, random.choice(("yes", "no", "unknown")), qos=1, retain=True)
+    return events
+
+def scenario_button_storm(bench):
+    pin = bench.button.button.pin
+    for i in range(200):
+        pin.drive_low()
+        time.sleep(0.005)
+        pin.drive_high()
+        time.sleep(0.005)
+    return []
+
+def scenario_wallpaper_swaps(bench):
+    from PIL import Image
+
+    events = []
+    for i in range(20):
+        image = Image.effect_noise((640, 480), random.randint(16, 128)).convert("RGB")
+        events.append(time.monotonic())
+        messagebus.publish("Display", "refresh", payload={"image": image})
+        time.sleep(0.5)
+    return events
+
+def scenario_downloads(bench):
+    from display import ImageDownloader
+
+    server = simulator.ImageServer(DOWNLOAD_IMAGE_SIZE)
+    threading.Thread(name="ImageServer", target=server.serve_forever, daemon=True).start()
+    max_size = 2 * len(server.wallpaper)
+    # Not started, we call it ourselves. Shares the store with the Bench's downloader.
+    store = bench.image_downloader.store
+    downloader = ImageDownloader(messagebus, {'url': f"{server.url}/wallpaper.jpg", 'max_size': max_size}, store)
+    details = {"max_size": max_size}
+
+    # A new image, then the same one again that the server says hasn't changed
+    for attempt in ("download", "not_modified"):
+        bytes_before = downloader.bytes_downloaded
+        unseen_before = store.unseen()
+        with PeakRSS() as peak:
+            downloader.prefetch(unseen_before + 1)
+        details[f"{attempt}_ok"] = (store.unseen() > unseen_before) == (attempt == "download")
+        details[f"{attempt}_bytes"] = downloader.bytes_downloaded - bytes_before
+        details[f"{attempt}_peak_rss"] = peak.rise
+    details["server_not_modified"] = server.not_modified
+
+    # An image that fails to decode must be downloaded again, not be "not modified"
+    downloader.url = f"{server.url}/broken.jpg"
+    for attempt in range(2):
+        downloader.prefetch(store.unseen() + 1)
+    details["broken_not_modified"] = server.not_modified - details["server_not_modified"]
+
+    # Too big, told by Content-Length or only found out while streaming
+    for kind in ("large", "stream"):
+        bytes_before = downloader.bytes_downloaded
+        with PeakRSS() as peak:
+            try:
+                downloader.fetch(f"{server.url}/{kind}/{4 * max_size}")
+                details[f"{kind}_aborted"] = False
+            except ValueError:
+                details[f"{kind}_aborted"] = True
+        details[f"{kind}_bytes"] = downloader.bytes_downloaded - bytes_before
+        details[f"{kind}_peak_rss"] = peak.rise
+
+    server.shutdown()
+    server.server_close()
+    return [], details
+
+def scenario_animations(bench):
+    from PIL import Image
+
+    # Blinking text with a scrolling subtext, then a crossfade to a new wallpaper underneath
+    events = [time.monotonic()]
+    messagebus.publish("Display", "display-message", payload={
+        "text": "YES", "color": "green", "blink": True, "expire": 6,
+        "subtext": "this subtext is far too long to fit on the panel so it scrolls",
+    })
+    time.sleep(3)
+    events.append(time.monotonic())
+    messagebus.publish("Display", "refresh", payload={"image": Image.effect_noise((640, 480), 64).convert("RGB")})
+    return events
+
+# Checks return what went wrong in a scenario's result, if anything
+
+def check_downloads(bench, result):
+    details = result['details']
+    failures = []
+    if not details['download_ok'] or not details['download_bytes']:
+        failures.append("the wallpaper wasn't downloaded")
+    if not details['not_modified_ok'] or details['not_modified_bytes'] or details['server_not_modified'] != 1:
+        failures.append("the unchanged wallpaper was downloaded again instead of a 304")
+    if details['broken_not_modified']:
+        failures.append("the image that failed to decode wasn't downloaded again")
+    for kind in ("large", "stream"):
+        if not details[f"{kind}_aborted"] or details[f"{kind}_bytes"]:
+            failures.append(f"the too big {kind} download wasn't refused")
+    return failures
+
+def check_mqtt_burst(bench, result):
+    failures = []
+    # The MQTT coalescing lets through at most one message per window,
+    # the first one straight away
+    max_frames = int(result['last_frame'] / bench.mqtt.coalesce_window) + 1
+    if result['frames'] > max_frames:
+        failures.append(f"{result['frames']} frames for {BURST_MESSAGES} messages, expected at most {max_frames}")
+    if result['cpu_total'] > BURST_CPU_LIMIT:
+        failures.append(f"CPU {result['cpu_total']:.2f} s, expected at most {BURST_CPU_LIMIT:.2f} s")
+    return failures
+
+CHECKS = {
+    "downloads": check_downloads,
+    "mqtt_burst": check_mqtt_burst,
+}
+
+SCENARIOS = {
+    "idle": scenario_idle,
+    "mqtt_single": scenario_mqtt_single,
+    "mqtt_burst": scenario_mqtt_burst,
+    "button_storm": scenario_button_storm,
+    "wallpaper_swaps": scenario_wallpaper_swaps,
+    "downloads": scenario_downloads,
+    "animations": scenario_animations,
+}
+
+def run_scenario(bench, name):
+    bench.settle(time.monotonic())
+    cpu_before = thread_cpu()
+    process_before = time.process_time()
+    frames_before = len(bench.frame_times)
+    bytes_before = bench.driver.bytes_sent
+    skipped_before = bench.display.frames_skipped
+    flusher = bench.display.flusher
+    stages_before = (bench.display.render_total, flusher.spi_total, flusher.transfer_total, flusher.flushed, flusher.replaced)
+    start_ts = time.monotonic()
+
+    events = SCENARIOS[name](bench)
+    details = {}
+    if isinstance(events, tuple):
+        events, details = events
+    injected_ts = time.monotonic()
+    bench.settle(injected_ts)
+
+    duration = time.monotonic() - start_ts
+    frames = bench.frame_times[frames_before:]
+    render, spi, transfer, flushed, replaced = (after - before for after, before in zip(
+        (bench.display.render_total, flusher.spi_total, flusher.transfer_total, flusher.flushed, flusher.replaced), stages_before))
+    cpu_after = thread_cpu()
+    cpu = {n: cpu_after[n] - cpu_before.get(n, 0) for n in cpu_after}
+
+    # Latency from each event to the first frame after it
+    latencies = []
+    for event_ts in events:
+        after = [ts for ts in frames if ts >= event_ts]
+        if after:
+            latencies.append(after[0] - event_ts)
+
+    result = {
+        "duration": duration,
+        "frames": len(frames),
+        "last_frame": (frames[-1] - start_ts) if frames else 0,
+        "fps": len(frames) / duration,
+        "spi_bytes": bench.driver.bytes_sent - bytes_before,
+        "frames_skipped": bench.display.frames_skipped - skipped_before,
+        "frames_replaced": replaced,
+        "render_avg": render / (flushed + replaced) if flushed + replaced else 0,
+        "spi_avg": spi / flushed if flushed else 0,
+        "transfer_avg": transfer / flushed if flushed else 0,
+        "latencies": latencies,
+        "settle": (frames[-1] - injected_ts) if frames and frames[-1] > injected_ts else 0,
+        "cpu_total": time.process_time() - process_before,
+        "cpu": cpu,
+        "details": details,
+    }
+    check = CHECKS.get(name)
+    result["failures"] = check(bench, result) if check else []
+    return result
+
+def report(name, result):
+    print(f"== {name}")
+    print(f"   duration {result['duration']:.1f} s, frames {result['frames']} ({result['fps']:.2f} fps, {result['frames_skipped']} skipped), SPI {result['spi_bytes']} bytes")
+    if result['latencies']:
+        latencies = result['latencies']
+        print(f"   latency p50 {percentile(latencies, 50)*1000:.1f} ms, p95 {percentile(latencies, 95)*1000:.1f} ms, max {max(latencies)*1000:.1f} ms ({len(latencies)} events)")
+    print(f"   settle {result['settle']*1000:.1f} ms after the last event")
+    print(f"   per frame: render {result['render_avg']*1000:.2f} ms, SPI {result['spi_avg']*1000:.2f} ms"
+          f" (transfer at {Bench.baudrate / 1e6:g} MHz {result['transfer_avg']*1000:.2f} ms), {result['frames_replaced']} stale frames replaced")
+    print(f"   CPU {result['cpu_total']:.2f} s total")
+    for thread, seconds in sorted(result['cpu'].items(), key=lambda item: -item[1]):
+        if seconds > 0:
+            print(f"      {seconds:6.2f} s  {thread}")
+    for key, value in result['details'].items():
+        print(f"   {key}: {value}")
+    for failure in result['failures']:
+        print(f"   FAIL: {failure}")
+
+def adafruit_convert_numpy(image):
+    # What adafruit_rgb_display's image() does with every frame when numpy is installed
+    import numpy
+    data = numpy.array(image.convert("RGB")).astype("uint16")
+    color = ((data[:, :, 0] & 0xF8) << 8) | ((data[:, :, 1] & 0xFC) << 3) | (data[:, :, 2] >> 3)
+    return bytes(numpy.dstack(((color >> 8) & 0xFF, color & 0xFF)).flatten().tolist())
+
+def adafruit_convert(image):
+    # ... and without numpy
+    pixels = bytearray(image.width * image.height * 2)
+    for i in range(image.width):
+        for j in range(image.height):
+            r, g, b = image.getpixel((i, j))
+            pix = (r & 0xF8) << 8 | (g & 0xFC) << 3 | b >> 3
+            pixels[2 * (j * image.width + i)] = pix >> 8
+            pixels[2 * (j * image.width + i) + 1] = pix & 0xFF
+    return pixels
+
+def rgb565_benchmark(seconds=2.0):
+    """
+    Frames/s and bytes allocated per frame of each RGB565 conversion path
+    """
+    from PIL import Image
+    import rgb565
+    from display import DISPLAY_WIDTH, DISPLAY_HEIGHT
+
+    frame = Image.effect_noise((DISPLAY_WIDTH, DISPLAY_HEIGHT), 64).convert("RGB")
+    rotation = DisplayDriver.ROTATION
+    paths = {
+        "adafruit (pixel loop)": lambda: adafruit_convert(frame.rotate(rotation, expand=True)),
+        "RGB565Buffer (Pillow)": None,
+    }
+    pillow_buffer = rgb565.RGB565Buffer(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+    def pillow_convert():
+        numpy, rgb565.numpy = rgb565.numpy, None
+        try:
+            return pillow_buffer.convert(frame, rotation)
+        finally:
+            rgb565.numpy = numpy
+    paths["RGB565Buffer (Pillow)"] = pillow_convert
+    if rgb565.numpy:
+        numpy_buffer = rgb565.RGB565Buffer(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        paths["adafruit (numpy)"] = lambda: adafruit_convert_numpy(frame.rotate(rotation, expand=True))
+        paths["RGB565Buffer (numpy)"] = lambda: numpy_buffer.convert(frame, rotation)
+
+    print("== rgb565")
+    expected = None
+    for name, convert in paths.items():
+        data = bytes(convert())
+        if expected is None:
+            expected = data
+        elif data != expected:
+            print(f"   {name}: output differs!")
+
+        frames = 0
+        start_ts = time.monotonic()
+        while time.monotonic() - start_ts < seconds:
+            convert()
+            frames += 1
+        fps = frames / (time.monotonic() - start_ts)
+
+        # Bytes allocated while converting a frame, the result included
+        tracemalloc.start()
+        for i in range(5):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            convert()
+            allocated = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        print(f"   {fps:8.1f} fps  {allocated:8d} bytes/frame allocated  {name}")
+
+# Keeps the components created by the micro benchmarks off the message bus
+OFFLINE_BUS = types.SimpleNamespace(subscribe=lambda *args: None, publish=lambda *args, **kwargs: None)
+
+def offline_display(driver):
+    """
+    A Display for 'driver' that isn't started, for its drawing code only
+    """
+    from display import Display
+
+    return Display(OFFLINE_BUS, driver=driver, name="Benchmark")
+
+def partial_benchmark():
+    """
+    SPI bytes per frame with and without partial updates, for an hour
+    of clock ticks and for messages coming and going over the clock
+    """
+    from PIL import Image
+    from display import WALLPAPER
+
+    controller = Controller(OFFLINE_BUS)
+    messages = [controller.mqtt_to_display(payload) for payload in ('yes', 'no', 'unknown')]
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for partial_updates in (False, True):
+            driver = DisplayDriver(partial_updates=partial_updates, backend="framebuffer")
+            display = offline_display(driver)
+            wallpaper = driver.fit_image(Image.open(WALLPAPER))
+            clock = [display.draw_clock(wallpaper, f"12:{minute:02d} PM") for minute in range(60)]
+            sequences = {
+                "clock ticks": clock,
+                "messages": [frame for message in messages for frame in (display.draw_message(wallpaper, message), clock[0])],
+            }
+            for name, frames in sequences.items():
+                # The first frame goes out in full either way
+                driver.display_image(frames[-1])
+                panel = driver._display
+                bytes_before, windows_before = panel.bytes_sent, panel.windows
+                for frame in frames:
+                    driver.display_image(frame)
+                results[name, partial_updates] = ((panel.bytes_sent - bytes_before) / len(frames),
+                                                  (panel.windows - windows_before) / len(frames))
+
+    print("== partial")
+    for name in sequences:
+        full, _ = results[name, False]
+        for partial_updates in (False, True):
+            nbytes, windows = results[name, partial_updates]
+            print(f"   {nbytes:8.0f} bytes/frame  {windows:5.1f} windows/frame  {nbytes / full * 100:5.1f}%  "
+                  f"{name}, {'partial' if partial_updates else 'full'} updates")
+
+def wallpaper_benchmark(seconds=2.0, size=(4000, 3000)):
+    """
+    Frames/s of draw_clock() + display_image() on a camera sized wallpaper,
+    resized on every frame (as it used to be) and fitted once up front
+    """
+    from PIL import Image
+    from wallpaper import fit_image
+
+    # Full frames every time, the clock text doesn't change
+    driver = DisplayDriver(partial_updates=False, backend="framebuffer")
+    wallpaper = Image.effect_noise(size, 64).convert("RGB")
+    paths = {
+        "resize every frame": lambda: driver.display_image(display.draw_clock(fit_image(wallpaper, driver.width, driver.height), "12:34 PM")),
+        "fit_image() once": lambda: driver.display_image(display.draw_clock(fitted, "12:34 PM")),
+    }
+
+    results = {}
+    # The Display and fit_image() report every resize, keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        display = offline_display(driver)
+        fitted = fit_image(wallpaper, driver.width, driver.height)
+        for name, frame in paths.items():
+            frames = 0
+            start_ts = time.monotonic()
+            while time.monotonic() - start_ts < seconds:
+                frame()
+                frames += 1
+            results[name] = (frames, time.monotonic() - start_ts)
+
+    print(f"== wallpaper ({size[0]}x{size[1]})")
+    for name, (frames, elapsed) in results.items():
+        print(f"   {frames / elapsed:8.1f} fps  {elapsed / frames * 1000:8.2f} ms/frame  {name}")
+
+MICROBENCHMARKS = {
+    "partial": partial_benchmark,
+    "rgb565": rgb565_benchmark,
+    "wallpaper": wallpaper_benchmark,
+}
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    verbose = "-v" in args
+    names = [a for a in args if a != "-v"] or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS and name not in MICROBENCHMARKS:
+            sys.exit(f"Unknown scenario: {name} (choose from {', '.join(list(SCENARIOS) + list(MICROBENCHMARKS))})")
+    for name in names:
+        if name in MICROBENCHMARKS:
+            MICROBENCHMARKS[name]()
+    names = [name for name in names if name in SCENARIOS]
+    if not names:
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as wallpaper_dir:
+        # The components are chatty, keep the report readable
+        with open(os.devnull, "w") as devnull:
+            quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)
+            with quiet:
+                bench = Bench(wallpaper_dir)
+                results = {name: run_scenario(bench, name) for name in names}
+        for name in names:
+            report(name, results[name])
+
+    # The component threads run forever, don't wait for them
+    sys.stdout.flush()
+    os._exit(1 if any(result['failures'] for result in results.values()) else 0)
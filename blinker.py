@@ -1,5 +1,5 @@
 import time
-from threading import Thread
+from threading import Thread, Condition
 from gpiozero import LED
 
 class Blinker(Thread):
@@ -14,7 +14,10 @@ class Blinker(Thread):
         self.led1 = LED(led1)
         self.led2 = LED(led2)
 
-        self.timer_expire = 0
+        # Deadlines are time.monotonic() timestamps, -1 = none.
+        # run() sleeps until the nearest one or until set_mode() wakes it up.
+        self._wakeup = Condition()
+        self.timer_expire = -1
         self.mode_expire = -1
 
         self.set_mode("idle")
@@ -23,13 +26,25 @@ class Blinker(Thread):
         self.messagebus.subscribe(component="Blinker", handler=self.message_handler)
 
     def run(self):
-        while True:
-            if 0 <= self.mode_expire <= time.time():
-                self.set_mode("idle")
-            if 0 <= self.timer_expire <= time.time():   # False if self.timer_expire==-1
-                self.toggle()
-                self.timer_expire = time.time() + self.period
-            time.sleep(self.FAST)
+        with self._wakeup:
+            while True:
+                self._wakeup.wait(self.next_timeout())
+                now = time.monotonic()
+                if 0 <= self.mode_expire <= now:
+                    self.set_mode("idle")
+                if 0 <= self.timer_expire <= now:
+                    self.toggle()
+                    # Schedule from the deadline, not from when we woke up, so that the cadence doesn't drift
+                    self.timer_expire += self.period
+                    if self.timer_expire <= now:
+                        # We've been stalled for more than a period, don't try to catch up
+                        self.timer_expire = now + self.period
+
+    def next_timeout(self):
+        deadlines = [ts for ts in (self.timer_expire, self.mode_expire) if ts >= 0]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
 
     def message_handler(self, component, message, payload={}):
         print(f"{self.name}: component={component} message={message} payload={payload}")
@@ -42,35 +57,35 @@ class Blinker(Thread):
     def set_period(self, period):
         print(f"Blinker: period set to {period}")
         self.period = period
-        self.timer_expire = 0
         self.toggle()
+        self.timer_expire = time.monotonic() + period
 
     def set_mode(self, mode, expire=None):
-        if expire is None:
-            expire_ts = time.time()
-            self.mode_expire = -1
-        else:
-            expire_ts = time.time() + expire
-            self.mode_expire = expire_ts
+        with self._wakeup:
+            if expire is None:
+                self.mode_expire = -1
+            else:
+                self.mode_expire = time.monotonic() + expire
 
-        if mode == "idle":
-            self.set_period(self.IDLE)
-        elif mode == "fast":
-            self.set_period(self.FAST)
-        elif mode == "slow":
-            self.set_period(self.SLOW)
-        elif mode == "red":
-            self.led1.value = False
-            self.led2.value = True
-            self.timer_expire = expire_ts
-        elif mode == "green":
-            self.led1.value = True
-            self.led2.value = False
-            self.timer_expire = expire_ts
-        elif mode == "off":
-            self.led1.value = False
-            self.led2.value = False
-            self.timer_expire = expire_ts
-        else:
-            print(f"{self.name}: Unknown mode: {mode}")
-            return
+            if mode == "idle":
+                self.set_period(self.IDLE)
+            elif mode == "fast":
+                self.set_period(self.FAST)
+            elif mode == "slow":
+                self.set_period(self.SLOW)
+            elif mode == "red":
+                self.led1.value = False
+                self.led2.value = True
+                self.timer_expire = -1      # Steady until the mode expires
+            elif mode == "green":
+                self.led1.value = True
+                self.led2.value = False
+                self.timer_expire = -1
+            elif mode == "off":
+                self.led1.value = False
+                self.led2.value = False
+                self.timer_expire = -1
+            else:
+                print(f"{self.name}: Unknown mode: {mode}")
+                return
+            self._wakeup.notify()
@@ -2,6 +2,8 @@ import time
 from threading import Thread
 import gpiozero
 
+import tracing
+
 class Button(Thread):
     def __init__(self, messagebus, button_pin):
         super().__init__(name="Button")
@@ -12,8 +14,10 @@ class Button(Thread):
         while True:
             print("Button: waiting for button press")
             self.button.wait_for_press()
+            tracing.start("button-pressed")
             self.messagebus.publish("Button", "pressed")
 
             print("Button: waiting for button release")
             self.button.wait_for_release()
+            tracing.start("button-released")
             self.messagebus.publish("Button", "released")
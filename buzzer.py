@@ -1,40 +1,133 @@
 import time
-from threading import Thread
+from collections import deque
+from threading import Thread, Condition
 from gpiozero import TonalBuzzer
 from gpiozero.tones import Tone
 
+STEP = 0.03     # Seconds per note of the default sweeps
+HOLD = 0.5      # Hold the last note of the default sweeps this long
+
 class Buzzer(Thread):
+    """
+    Plays tunes on its own thread so that message_handler() returns
+    immediately. A tune is a list of (frequency, duration) steps,
+    frequency 0 is silence. The Tone objects are built once at startup,
+    frequencies outside the buzzer's range are clamped to it.
+
+    A new "play" preempts whatever is playing unless the payload
+    says "queue": true, "cancel" stops playing and drops the queue.
+    """
     def __init__(self, messagebus, buzzer_pin, config):
         super().__init__(name="Buzzer")
         self.buzzer = TonalBuzzer(buzzer_pin)
         self.messagebus = messagebus
+
+        defaults = self.default_tunes()
+        self.tunes = {name: self.precompute(name, steps) for name, steps in defaults.items()}
+        for name, steps in config.get('tunes', {}).items():
+            try:
+                self.tunes[name] = self.precompute(name, steps)
+            except (TypeError, ValueError) as e:
+                print(f"{self.name}: Ignoring tune {name}: {e}" + (", playing the default" if name in defaults else ""))
+
+        self._cond = Condition()
+        self._queue = deque()       # Tunes waiting to be played
+        self._interrupt = False     # Stop the current tune
+
         if config.get('enabled', True):
             self.messagebus.subscribe(component="Buzzer", handler=self.message_handler)
 
+    def default_tunes(self):
+        up = [Tone(midi=midi).frequency for midi in range(self.buzzer.min_tone.midi, self.buzzer.max_tone.midi)]
+        down = [Tone(midi=midi).frequency for midi in range(self.buzzer.max_tone.midi, self.buzzer.min_tone.midi, -1)]
+        return {
+            "yes": [(f, STEP) for f in up] + [(up[-1], HOLD)],
+            "no": [(f, STEP) for f in down] + [(down[-1], HOLD)],
+        }
+
+    def precompute(self, name, steps):
+        """
+        Build the Tones of 'steps', clamping the frequencies that
+        the buzzer can't play to its range
+        """
+        low, high = self.buzzer.min_tone.frequency, self.buzzer.max_tone.frequency
+        tones = []
+        for frequency, duration in steps:
+            tone = None
+            if frequency:
+                # Before Tone(), it refuses frequencies far out of the audible range
+                clamped = min(max(float(frequency), low), high)
+                if clamped != frequency:
+                    print(f"{self.name}: Tune {name}: {frequency:g} Hz is out of range, playing {clamped:g} Hz")
+                tone = Tone(frequency=clamped)
+            tones.append((tone, float(duration)))
+        return tones
+
     def message_handler(self, component, message, payload={}):
         print(f"{self.name}: component={component} message={message} payload={payload}")
         if message == "play":
-            self.play(payload['tune'])
+            self.play(payload['tune'], queue=payload.get('queue', False))
+        elif message == "cancel":
+            self.cancel()
         else:
             print(f"{self.name}: Unknown message: {message}")
 
-    def play(self, tune):
-        tones = []
-        if tune == "yes":
-            tones = range(self.buzzer.min_tone.midi, self.buzzer.max_tone.midi)
-        elif tune == "no":
-            tones = range(self.buzzer.max_tone.midi, self.buzzer.min_tone.midi, -1)
-        if not tones:
-            return
-        for tone in tones:
-            self.buzzer.play(Tone(midi=tone))
-            time.sleep(0.03)
-        time.sleep(0.5)
-        self.buzzer.stop()
+    def play(self, tune, queue=False):
+        """
+        Start playing 'tune', or with queue=True play it after the current and queued ones.
+        An unknown tune (e.g. "unknown") only silences what's playing.
+        """
+        with self._cond:
+            if not queue:
+                self._queue.clear()
+                self._interrupt = True
+            if tune in self.tunes:
+                self._queue.append(self.tunes[tune])
+            self._cond.notify()
+
+    def cancel(self):
+        self.play(None)
+
+    def run(self):
+        steps = deque()
+        deadline = 0
+        with self._cond:
+            while True:
+                if self._interrupt:
+                    steps.clear()
+                    self._interrupt = False
+                if not steps:
+                    if not self._queue:
+                        self.buzzer.stop()
+                        self._cond.wait()
+                        continue
+                    steps.extend(self._queue.popleft())
+                    deadline = time.monotonic()
+
+                tone, duration = steps.popleft()
+                try:
+                    if tone is None:
+                        self.buzzer.stop()
+                    else:
+                        self.buzzer.play(tone)
+                except Exception as e:
+                    # One bad step must not stop the thread for good
+                    print(f"{self.name}: {e}")
+
+                # Step deadlines are cumulative so scheduling delays don't add up,
+                # and a new command cuts the wait short.
+                deadline += duration
+                while not self._interrupt:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
 
 if __name__ == "__main__":
     from messagebus import messagebus
-    b = Buzzer(messagebus, "GPIO3")
+    b = Buzzer(messagebus, "GPIO3", {})
+    b.daemon = True
+    b.start()
     b.play('yes')
-    time.sleep(1)
-    b.play('no')
+    b.play('no', queue=True)
+    time.sleep(5)
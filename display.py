@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
 import time
+import math
+import hashlib
+import functools
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Condition, Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
 from io import BytesIO
 
-import digitalio
-import board
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
-import requests
-import adafruit_rgb_display.st7735 as st7735
-from PIL import Image, ImageDraw, ImageFont
+import tracing
+from rgb565 import RGB565Buffer
+from wallpaper import fit_image, WALLPAPER_PREFETCH
 
 TIME_FORMAT = "%I:%M %p"
 FONT_FILE = "fonts/bttf.ttf"
@@ -21,31 +25,70 @@ WALLPAPER = "images/wallpaper.jpg"  # Initial image
 WALLPAPER_CHANGE = 60   # Seconds
 DISPLAY_WIDTH = 160
 DISPLAY_HEIGHT = 128
+PARTIAL_UPDATES = True  # Only send the changed parts of the frame over SPI
+PARTIAL_BAND = 8        # Rows per band when looking for changed regions
+TEXT_CACHE_SIZE = 64    # Rendered text sprites to keep
+FRAME_CACHE_SIZE = 16   # Composed message frames to keep per wallpaper
+DOWNLOAD_MAX_SIZE = 5*1024*1024 # Bytes - refuse to download bigger images
+DOWNLOAD_CHUNK = 64*1024
+DOWNLOAD_TIMEOUT = 30   # Seconds
+FRAME_RATE = 20         # Frames/s to aim for while animating
+FPS_WINDOW = 1.0        # Seconds to measure the achieved frame rate over
+CROSSFADE = 1.0         # Seconds to fade between wallpapers, 0 = switch straight away
+BLINK_PERIOD = 1.0      # Seconds, for payloads with 'blink': true
+MARQUEE_SPEED = 30      # Pixels/s to scroll subtext that doesn't fit the panel
+MARQUEE_GAP = 40        # Pixels between the end of the subtext and its next pass
 
 class DisplayDriver:
-    # GPIO configuration
-    CS_PIN = board.CE0
-    DC_PIN = board.D25
-    RESET_PIN = board.D24
-    BL_PIN = board.D23
-    
+    # GPIO configuration - names of the 'board' pins
+    CS_PIN = "CE0"
+    DC_PIN = "D25"
+    RESET_PIN = "D24"
+    BL_PIN = "D23"
+
     # Display baudrate
     BAUDRATE = 32000000
+    ROTATION = 180
 
-    def __init__(self):
-        self._display = st7735.ST7735S(
-            spi=board.SPI(),
-            rotation=180,
-            bl=digitalio.DigitalInOut(self.BL_PIN),
-            cs=digitalio.DigitalInOut(self.CS_PIN),
-            dc=digitalio.DigitalInOut(self.DC_PIN),
-            rst=digitalio.DigitalInOut(self.RESET_PIN),
-            baudrate=self.BAUDRATE,
-            x_offset=0,
-            y_offset=0,
-            width=DISPLAY_WIDTH,
-            height=DISPLAY_HEIGHT,
-        )
+    BACKENDS = ("st7735", "framebuffer")
+
+    # Shared by all the panels on the SPI bus
+    _spi = None
+    _pins = {}
+    # Held for each whole window write. The panels share DC, and the driver
+    # sets it outside its own SPI lock, so another panel's thread could
+    # flip it between a command and its data.
+    _bus_lock = Lock()
+
+    def __init__(self, partial_updates=PARTIAL_UPDATES, backend="st7735", png_path=None, pins={}, baudrate=None):
+        """
+        backend: "st7735" for the real SPI panel or "framebuffer"
+                 for the in-memory simulator (see simulator.py)
+        png_path: with the framebuffer backend save each frame here
+        pins: override the default 'cs', 'dc', 'reset' and 'backlight' pins,
+              e.g. a different chip select for each panel
+        baudrate: SPI clock, also used to estimate the transfer time
+        """
+        self.partial_updates = partial_updates
+        self.baudrate = baudrate or self.BAUDRATE
+        self.last_frame = None  # The frame on the panel now
+        self.bytes_sent = 0     # Pixel bytes pushed over SPI since start
+        self.last_bytes = 0     # ... by the last display_image()
+        self.frames = 0
+        self.on_frame = None    # Called after each frame is pushed, e.g. by benchmarks
+
+        if backend == "framebuffer":
+            from simulator import FramebufferPanel
+            self._display = FramebufferPanel(DISPLAY_WIDTH, DISPLAY_HEIGHT, rotation=self.ROTATION)
+            if png_path:
+                self.on_frame = lambda: self._display.save(png_path)
+        elif backend == "st7735":
+            self._display = self.open_st7735(pins)
+        else:
+            raise ValueError(f"Unknown display backend: {backend}")
+
+        # Every frame is converted into this one buffer
+        self._rgb565 = RGB565Buffer(DISPLAY_WIDTH, DISPLAY_HEIGHT)
 
         # we swap height/width to rotate it to landscape!
         if self._display.rotation % 180 == 90:
@@ -55,81 +98,637 @@ class DisplayDriver:
             self.width = self._display.width
             self.height = self._display.height
 
+    @classmethod
+    def from_config(cls, config):
+        """
+        Driver for the [Display] (or [[Panel]]) section 'config'
+        """
+        return cls(
+            partial_updates=config.get('partial_updates', PARTIAL_UPDATES),
+            backend=config.get('backend', "st7735"),
+            png_path=config.get('png_path'),
+            pins={pin: config[f"{pin}_pin"] for pin in ('cs', 'dc', 'reset', 'backlight') if f"{pin}_pin" in config},
+            baudrate=config.get('baudrate'),
+        )
+
+    def open_st7735(self, pins):
+        # Only needed (and only installable) on the Pi
+        import digitalio
+        import board
+        import adafruit_rgb_display.st7735 as st7735
+
+        def pin(name):
+            # Panels can share DC, reset and backlight - open each pin only once
+            if name not in DisplayDriver._pins:
+                DisplayDriver._pins[name] = digitalio.DigitalInOut(getattr(board, name))
+            return DisplayDriver._pins[name]
+
+        # Don't reset the panels that are already initialised
+        reset_pin = pins.get('reset', self.RESET_PIN)
+        rst = None if reset_pin in DisplayDriver._pins else pin(reset_pin)
+
+        if DisplayDriver._spi is None:
+            DisplayDriver._spi = board.SPI()
+
+        # The init sequence goes over the shared bus too
+        with DisplayDriver._bus_lock:
+            return st7735.ST7735S(
+                spi=DisplayDriver._spi,
+                rotation=self.ROTATION,
+                bl=pin(pins.get('backlight', self.BL_PIN)),
+                cs=pin(pins.get('cs', self.CS_PIN)),
+                dc=pin(pins.get('dc', self.DC_PIN)),
+                rst=rst,
+                baudrate=self.baudrate,
+                x_offset=0,
+                y_offset=0,
+                width=DISPLAY_WIDTH,
+                height=DISPLAY_HEIGHT,
+            )
+
+    def fit_image(self, image):
+        """
+        Scale and center-crop 'image' to exactly fill the panel
+        and convert it to RGB. Done once per wallpaper so that
+        display_image() gets a ready-to-blit frame.
+        """
+        return fit_image(image, self.width, self.height)
+
     def display_image(self, image):
         """
-        image: PIL Image() object
+        image: PIL Image() object, panel sized and RGB (see fit_image())
         """
-        if image.width > self.width or image.height > self.height:
-            # If any dimension is bigger than our display scale it down
-            print(f"Resizing from {image.width}x{image.height} to {self.width}x{self.height}")
-            image_ratio = image.width / image.height
-            screen_ratio = self.width / self.height
-            if screen_ratio > image_ratio:
-                scaled_width = image.width * self.height // image.height
-                scaled_height = self.height
+        boxes = self.frame_boxes(image)
+        self.last_frame = image
+        self.push_frame(image, boxes)
+
+    def frame_boxes(self, image):
+        """
+        The regions of 'image' that differ from the frame on the panel,
+        None if the whole frame has to be sent
+        """
+        if not self.partial_updates or self.last_frame is None or self.last_frame.size != image.size:
+            return None
+        return self.changed_boxes(self.last_frame, image)
+
+    def push_frame(self, image, boxes=None):
+        """
+        Send the 'boxes' regions of 'image' to the panel, all of it if None.
+        Each region goes out as one window, in as few SPI writes as the bus allows.
+        """
+        bytes_before = self.bytes_sent
+        with tracing.span("spi"):
+            if boxes is None:
+                # Display image.
+                self.push(image, 0, 0)
             else:
-                scaled_width = self.width
-                scaled_height = image.height * self.width // image.width
-            image = image.resize((scaled_width, scaled_height), Image.BICUBIC)
-        
-            # Center the image
-            x = image.width // 2 - self.width // 2
-            y = image.height // 2 - self.height // 2
-            image = image.crop((x, y, x + self.width, y + self.height))
-        
-        # Display image.
-        self._display.image(image)
+                for box in boxes:
+                    self.display_region(image, box)
+        self.last_bytes = self.bytes_sent - bytes_before
+        self.frames += 1
+        if self.on_frame:
+            self.on_frame()
+
+    def transfer_time(self, nbytes):
+        """
+        Seconds the SPI bus needs for 'nbytes' of pixels at our baudrate
+        """
+        return nbytes * 8 / self.baudrate
+
+    def changed_boxes(self, old, new):
+        """
+        Return a list of (left, top, right, bottom) boxes covering
+        the pixels that differ between the old and new frame.
+        Text in different parts of the screen ends up in separate
+        boxes so that we don't resend everything in between.
+        """
+        diff = ImageChops.difference(old, new)
+        boxes = []
+        for top in range(0, diff.height, PARTIAL_BAND):
+            bottom = min(top + PARTIAL_BAND, diff.height)
+            bbox = diff.crop((0, top, diff.width, bottom)).getbbox()
+            if not bbox:
+                continue
+            box = (bbox[0], top + bbox[1], bbox[2], top + bbox[3])
+            if boxes and boxes[-1][3] == top:
+                # Directly below the previous box - merge them
+                last = boxes.pop()
+                box = (min(last[0], box[0]), last[1], max(last[2], box[2]), box[3])
+            boxes.append(box)
+        return boxes
+
+    def display_region(self, image, box):
+        """
+        Send only the 'box' part of 'image' to the panel.
+        The driver rotates the image in software so we have to
+        map the box to the physical panel coordinates ourselves.
+        """
+        left, top, right, bottom = box
+        rotation = self._display.rotation
+        if rotation == 90:
+            x, y = top, self.width - right
+        elif rotation == 180:
+            x, y = self.width - right, self.height - bottom
+        elif rotation == 270:
+            x, y = self.height - bottom, left
+        else:
+            x, y = left, top
+        self.push(image.crop(box), x, y)
+
+    def frame_rgb565(self):
+        """
+        The frame on the panel as raw RGB565 in the panel's own orientation,
+        valid until the next frame is pushed. See display_rgb565().
+        """
+        return self._rgb565.convert(self.last_frame, self._display.rotation)
+
+    def display_rgb565(self, data):
+        """
+        Push a whole frame of raw RGB565 as returned by frame_rgb565(),
+        e.g. from a snapshot saved before a restart.
+        """
+        width, height = self._display.width, self._display.height
+        if len(data) != width * height * 2:
+            raise ValueError(f"Expected {width * height * 2} bytes of RGB565, got {len(data)}")
+        with DisplayDriver._bus_lock:
+            self._display._block(0, 0, width - 1, height - 1, data)
+        self.bytes_sent += len(data)
+
+    def push(self, image, x, y):
+        """
+        Send 'image' to the panel at physical position x, y.
+        Does what the driver's image() does, except that the RGB565
+        conversion is ours, see rgb565.py.
+        """
+        rotation = self._display.rotation
+        data = self._rgb565.convert(image, rotation)
+        width, height = (image.height, image.width) if rotation % 180 == 90 else image.size
+        # _block() is what image() sends the converted pixels with
+        with DisplayDriver._bus_lock:
+            self._display._block(x, y, x + width - 1, y + height - 1, data)
+        self.bytes_sent += len(data)
+
+class FrameFlusher(Thread):
+    """
+    Pushes frames to the panel on its own thread, so that the Display
+    composes the next frame while the previous one is on the SPI bus.
+
+    There are two reusable frame buffers. The Display takes the back
+    buffer with back_buffer(), composes into it and hands it over with
+    submit(). The flusher works out the changed regions against the
+    front buffer (the frame on the panel), hands the front buffer back
+    for composing and only then streams the new frame. A submitted frame
+    that is still waiting when the Display starts composing the next one
+    is stale - the Display gets it back to compose into instead of the
+    frames queueing up behind a slow bus.
+    """
+    def __init__(self, driver, on_flushed=None, name="Flusher"):
+        """
+        on_flushed: called as on_flushed(image, info) after each frame
+                    is on the panel, with the 'info' from submit()
+        """
+        super().__init__(name=name, daemon=True)
+        self.driver = driver
+        self.on_flushed = on_flushed
+        self._buffers = [Image.new("RGB", (driver.width, driver.height)) for i in range(2)]
+        self._free = list(self._buffers)
+        self._pending = None    # (image, trace_id, info)
+        self._cond = Condition()
+
+        # Per stage timings
+        self.flushed = 0
+        self.replaced = 0       # Stale frames composed over before they were flushed
+        self.errors = 0         # Frames that failed to go out
+        self.wait_total = 0.0   # Display waiting for a free buffer
+        self.diff_total = 0.0   # Working out the changed regions
+        self.spi_total = 0.0    # Converting and sending the frames
+        self.spi_max = 0.0
+        self.transfer_total = 0.0   # ... what the SPI transfer alone takes at the baudrate
+        self.last_cost = 0.0    # Time the last frame kept the flusher busy
+
+    def back_buffer(self):
+        """
+        A frame buffer to compose the next frame into
+        """
+        start_ts = time.monotonic()
+        with self._cond:
+            if self._pending:
+                self._free.append(self._pending[0])
+                self._pending = None
+                self.replaced += 1
+            while not self._free:
+                self._cond.wait()
+            image = self._free.pop()
+        self.wait_total += time.monotonic() - start_ts
+        return image
+
+    def submit(self, image, info=None):
+        with self._cond:
+            self._pending = (image, tracing.current(), info)
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                image, trace_id, info = self._pending
+                self._pending = None
+            tracing.set_current(trace_id)
+
+            start_ts = time.monotonic()
+            try:
+                boxes = self.driver.frame_boxes(image)
+                old = self.driver.last_frame
+                self.driver.last_frame = image
+                with self._cond:
+                    # Only the diff needed the old front buffer, it's free to compose into now
+                    if any(old is buffer for buffer in self._buffers):
+                        self._free.append(old)
+                        self._cond.notify_all()
+                diff_ts = time.monotonic()
+                self.driver.push_frame(image, boxes)
+            except Exception as e:
+                print(f"{self.name}: {e}")
+                self.errors += 1
+                self.recover(image)
+                continue
+            end_ts = time.monotonic()
+
+            transfer = self.driver.transfer_time(self.driver.last_bytes)
+            self.flushed += 1
+            self.diff_total += diff_ts - start_ts
+            self.spi_total += end_ts - diff_ts
+            self.spi_max = max(self.spi_max, end_ts - diff_ts)
+            self.transfer_total += transfer
+            self.last_cost = max(end_ts - start_ts, transfer)
+
+            if self.on_flushed:
+                try:
+                    self.on_flushed(image, info)
+                except Exception as e:
+                    print(f"{self.name}: {e}")
+
+    def recover(self, image):
+        """
+        After a failed push: we don't know what's on the panel, so the next
+        frame goes out in full, and no buffer is the front buffer any more
+        """
+        with self._cond:
+            front = self.driver.last_frame
+            self.driver.last_frame = None
+            for buffer in (image, front):
+                if any(buffer is ours for ours in self._buffers) and not any(buffer is free for free in self._free):
+                    self._free.append(buffer)
+            self._cond.notify_all()
+
+    def stats(self):
+        flushed = self.flushed or 1
+        return {
+            "flushed": self.flushed,
+            "replaced": self.replaced,
+            "errors": self.errors,
+            "wait_avg": self.wait_total / flushed,
+            "diff_avg": self.diff_total / flushed,
+            "spi_avg": self.spi_total / flushed,
+            "spi_max": self.spi_max,
+            "transfer_avg": self.transfer_total / flushed,
+        }
+
+class TextCache:
+    """
+    LRU cache of rendered text sprites.
+
+    Rasterising stroked text with FreeType is the most expensive part
+    of a frame and we keep drawing the same few strings over and over.
+    Each sprite is an RGBA image of just the text bounding box, with
+    the stroke included and transparent background, ready to be pasted
+    onto the wallpaper using its own alpha as the mask.
+    """
+    def __init__(self, size=TEXT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()     # Used from the render and the frame warming threads
+
+    def get(self, text, font, fill, stroke_width=1, stroke_fill=(0,0,0)):
+        """
+        Returns (sprite, bbox) where bbox is the text bounding box
+        relative to the drawing origin, same as ImageDraw.textbbox()
+        """
+        key = (text, font, fill, stroke_width, stroke_fill)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        bbox = font.getbbox(text, stroke_width=stroke_width)
+        sprite = Image.new("RGBA", (bbox[2]-bbox[0], bbox[3]-bbox[1]), (0,0,0,0))
+        draw = ImageDraw.Draw(sprite)
+        draw.text((-bbox[0], -bbox[1]), text, font=font, fill=fill, stroke_width=stroke_width, stroke_fill=stroke_fill)
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = (sprite, bbox)
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return sprite, bbox
+
+    @staticmethod
+    def paste(image, sprite, bbox, xy):
+        """
+        Paste the sprite where ImageDraw.text(xy, ...) would have drawn it
+        """
+        image.paste(sprite, (round(xy[0]) + bbox[0], round(xy[1]) + bbox[1]), sprite)
+
+# Everything a frame is rendered from. Never modified, set_mode() and
+# update_image() publish a new one by swapping Display.state, so the
+# render loop can read it once per frame without locking.
+#   expire: time.time() when the mode expires, -1 = never
+#   frames: composed message frames for this wallpaper, see message_frame()
+#   since: time.monotonic() when the mode was set, animations run from here
+DisplayState = namedtuple("DisplayState", ("mode", "data", "expire", "image", "frames", "since"))
 
 class Display(Thread):
     MODES = ("clock", "message")
     MODE_IDLE = "clock"
 
-    def __init__(self, messagebus):
-        super().__init__(name="Display")
+    def __init__(self, messagebus, config={}, wallpaper=WALLPAPER, name=None, text_cache=None, driver=None, snapshot=None):
+        """
+        name: panel name when driving more than one, the Display then
+              listens on "Display_<name>" plus "Display" for the shared
+              messages like wallpaper refresh.
+        text_cache: TextCache shared between the panels
+        driver: DisplayDriver opened early, e.g. to show the snapshot
+        snapshot: Snapshot to restore the mode from and to save the frames to
+        """
+        super().__init__(name=f"Display-{name}" if name else "Display")
+        self.component = f"Display_{name}" if name else "Display"
+
+        # Fonts and the wallpaper load while the SPI display initialises
+        with ThreadPoolExecutor(thread_name_prefix="DisplayInit") as pool:
+            fonts = pool.submit(self.load_fonts)
+            initial_image = pool.submit(self.load_image, wallpaper)
+            self.driver = driver or DisplayDriver.from_config(config)
+            self.font_time, self.font_text, self.font_subtext = fonts.result()
+            initial_image = initial_image.result()
+        self.text_cache = text_cache or TextCache(config.get('text_cache_size', TEXT_CACHE_SIZE))
+
+        # run() sleeps on this until the next deadline or until
+        # message_handler() tells it that something has changed
+        self._wakeup = Condition()
+        self._woken = False
+        self._trace = None      # Trace of the last state change, see tracing.py
+        self._redraw = True     # Draw even if the text hasn't changed, e.g. new wallpaper
+
+        # Animations (crossfade, blinking and scrolling text) are
+        # composed at up to this rate, slower if the SPI can't keep up
+        self.frame_interval = 1 / config.get('fps', FRAME_RATE)
+        self.crossfade = config.get('crossfade', CROSSFADE)
+        self._next_frame = None     # time.monotonic() of the next animation frame, None = not animating
+        self.fps = 0.0              # Achieved, over the last FPS_WINDOW
+        self.frames_skipped = 0
+        self._fps_frames = 0
+        self._fps_since = time.monotonic()
 
-        self.driver = DisplayDriver()
-        self.font_time = ImageFont.truetype(FONT_FILE, FONT_SIZE_TIME)
-        self.font_text = ImageFont.truetype(FONT_FILE, FONT_SIZE_TEXT)
-        self.font_subtext = ImageFont.truetype(FONT_FILE, FONT_SIZE_SUBTEXT)
-        self.image = Image.open(WALLPAPER)  # Initial image
+        # Composing (this thread) and the SPI transfer (flusher) overlap
+        self.flusher = FrameFlusher(self.driver, self.flushed, name=f"{self.name}-Flusher")
+        self.render_total = 0.0
+        self.render_max = 0.0
+        self._first_frame = True
+        self._saved_state = None
+
+        # Serialises the writers of self.state, the render loop doesn't need it
+        self._state_lock = Lock()
+        self.state = DisplayState(self.MODE_IDLE, {}, -1, None, {}, time.monotonic())
+        self._preload = []
+        self.snapshot = snapshot
+        self.wallpaper = wallpaper      # Path of the wallpaper shown, for the snapshot
+
+        self.update_image(initial_image)
 
         # Only subscribe to messagebus after we have the initial image
         self.messagebus = messagebus
-        self.messagebus.subscribe("Display", self.message_handler)
+        self.messagebus.subscribe(self.component, self.message_handler)
+        if self.component != "Display":
+            self.messagebus.subscribe("Display", self.message_handler)
 
         self.set_mode(self.MODE_IDLE)
+        if snapshot:
+            self.restore(snapshot.state)
+
+    @staticmethod
+    @functools.lru_cache()
+    def load_fonts():
+        # Cached - all the panels share the same fonts
+        return (
+            ImageFont.truetype(FONT_FILE, FONT_SIZE_TIME),
+            ImageFont.truetype(FONT_FILE, FONT_SIZE_TEXT),
+            ImageFont.truetype(FONT_FILE, FONT_SIZE_SUBTEXT),
+        )
+
+    @staticmethod
+    def load_image(path):
+        image = Image.open(path)
+        image.load()
+        return image
 
     def run(self):
+        self.flusher.start()
         _last = None
+        fade_from = None    # Frame we're fading away from
         while True:
-            time.sleep(0.1)
+            with self._wakeup:
+                if not self._woken and not self._redraw:
+                    self._wakeup.wait(self.next_timeout())
+                redraw = self._redraw
+                self._woken = self._redraw = False
+                trace_id = self._trace
+                self._trace = None
+            tracing.set_current(trace_id)
 
-            image = None
+            state = self.state
+            if 0 < state.expire <= time.time():
+                self.expire_if(state)
+                state = self.state
 
-            if 0 < self.mode_expire < time.time():
-                self.set_mode(self.MODE_IDLE)
+            frame_start = time.monotonic()
+            fade = None
+            if redraw and self.crossfade > 0 and self.driver.last_frame is not None:
+                # New wallpaper - fade to it from whatever is on the panel now.
+                # A copy, the flusher will hand that buffer back to us to compose into.
+                fade_from, fade_start = self.driver.last_frame.copy(), frame_start
+            if fade_from is not None:
+                fade = (frame_start - fade_start) / self.crossfade
+                if fade >= 1:
+                    # Done, push the final frame unblended
+                    fade_from = fade = None
+                    redraw = True
 
-            if self.mode == "clock":
-                text = datetime.strftime(datetime.now(), TIME_FORMAT).lstrip('0')
-                if text == _last:
-                    continue
-                image = self.draw_clock(self.image, text)
-                _last = text
-            elif self.mode == "message":
-                if self.mode_data == _last:
-                    continue
-                image = self.draw_message(self.image, self.mode_data)
-                _last = self.mode_data
+            view, animated = self.view(state, frame_start)
+            animated = animated or fade is not None
+            self._next_frame = frame_start + self.frame_interval if animated else None
 
-            if image:
-                self.driver.display_image(image)
+            if view == _last and not redraw and fade is None:
+                continue
+            if state.mode == "clock" and trace_id is None:
+                tracing.start("clock-tick")
+
+            image = self.flusher.back_buffer()
+            render_start = time.monotonic()
+            self.compose(state, view, image)
+            if fade is not None:
+                image.paste(Image.blend(fade_from, image, fade))
+            self.render_total += time.monotonic() - render_start
+            self.render_max = max(self.render_max, time.monotonic() - render_start)
+            self.flusher.submit(image, (state, fade is None))
+            _last = view
+
+            self.frame_done(frame_start, animated)
+
+    def flushed(self, image, info):
+        """
+        Called by the flusher once a frame is on the panel
+        """
+        state, final = info
+        if self._first_frame:
+            self.messagebus.publish("Startup", "first-frame")
+            self._first_frame = False
+        if self.snapshot and state is not self._saved_state and final:
+            self.save_snapshot(state)
+            self._saved_state = state
+
+    def frame_done(self, frame_start, animated):
+        """
+        Measure the frame rate and, if composing or pushing a frame takes
+        longer than the frame interval, skip the frames we have no time for.
+        The two overlap, the slower one sets the pace. On the framebuffer
+        backend the SPI time is estimated from the baudrate.
+        """
+        now = time.monotonic()
+        self._fps_frames += 1
+        if now - self._fps_since >= FPS_WINDOW:
+            self.fps = self._fps_frames / (now - self._fps_since)
+            self._fps_frames = 0
+            self._fps_since = now
+
+        cost = max(now - frame_start, self.flusher.last_cost)
+        if animated and cost > self.frame_interval:
+            self.frames_skipped += math.ceil(cost / self.frame_interval) - 1
+            self._next_frame = frame_start + cost
+
+    def save_snapshot(self, state):
+        """
+        Save the state and the frame just pushed, once per state change
+        """
+        try:
+            self.snapshot.update(frame=self.driver.frame_rgb565(), mode=state.mode, data=state.data,
+                                 expire=state.expire, wallpaper=self.wallpaper)
+        except Exception as e:
+            print(f"{self.name}: Saving snapshot failed: {e}")
+
+    def restore(self, saved):
+        """
+        Carry on with the mode saved in the snapshot, unless it has expired
+        """
+        mode = saved.get('mode')
+        expire = saved.get('expire', -1)
+        if mode not in self.MODES or 0 < expire <= time.time():
+            return
+        self.set_mode(mode, data=saved.get('data', {}))
+        with self._state_lock:
+            self.state = self.state._replace(expire=expire)
+
+    def stats(self):
+        frames = self.flusher.flushed + self.flusher.replaced or 1
+        return {
+            "fps": self.fps,
+            "target_fps": 1 / self.frame_interval,
+            "frames": self.driver.frames,
+            "frames_skipped": self.frames_skipped,
+            "spi_bytes": self.driver.bytes_sent,
+            "render_avg": self.render_total / frames,
+            "render_max": self.render_max,
+            **self.flusher.stats(),
+        }
+
+    def view(self, state, now):
+        """
+        Describe the frame to show at 'now' without drawing it, cheap to
+        compare with the previous one. Returns (view, animated) where
+        'animated' means that the frame changes over time on its own.
+        """
+        if state.mode == "clock":
+            return ("clock", datetime.strftime(datetime.now(), TIME_FORMAT).lstrip('0')), False
+
+        text, color, subtext, subtext_color, blink = self.message_style(state.data)
+        elapsed = now - state.since
+        show_text = True
+        if blink:
+            period = BLINK_PERIOD if blink is True else blink
+            show_text = elapsed % period < period / 2
+        offset = None
+        if subtext:
+            sprite, _ = self.text_cache.get(subtext, self.font_subtext, subtext_color)
+            if sprite.width > state.image.width:
+                offset = int(elapsed * MARQUEE_SPEED) % (sprite.width + MARQUEE_GAP)
+        return ("message", self.frame_key(state.data), show_text, offset), bool(blink) or offset is not None
+
+    def compose(self, state, view, out):
+        """
+        Compose the frame described by 'view' into the 'out' frame buffer
+        """
+        if view[0] == "clock":
+            self.draw_clock(state.image, view[1], out)
+            return
+        _, _, show_text, offset = view
+        frame = self.message_frame(state, show_text)
+        if offset is not None:
+            self.draw_marquee(frame, state.data, offset, out)
+        else:
+            out.paste(frame)
+
+    def next_timeout(self):
+        """
+        Seconds until run() has something to do on its own:
+        the next minute in clock mode, the mode expiry and/or
+        the next animation frame.
+        None means wait until woken up.
+        """
+        state = self.state
+        now = time.time()
+        deadlines = []
+        if state.mode == "clock":
+            deadlines.append(now - now % 60 + 60)
+        if state.expire > 0:
+            deadlines.append(state.expire)
+        if self._next_frame is not None:
+            deadlines.append(now + self._next_frame - time.monotonic())
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - now)
+
+    def wakeup(self, redraw=False):
+        with self._wakeup:
+            self._woken = True
+            self._trace = tracing.current()
+            self._redraw = self._redraw or redraw
+            self._wakeup.notify()
 
     def message_handler(self, component, message, payload={}):
         print(f"{self.name}: component={component} message={message} payload={payload}")
         if message == "display-message":
             self.set_mode("message", data=payload)
+            self.wakeup()
         elif message == "refresh":
             self.update_image(payload['image'])
+            self.wallpaper = payload.get('path')
+            self.wakeup(redraw=True)
+        elif message == "preload":
+            self._preload = payload['messages']
+            self.warm_frames()
         else:
             print(f"{self.name}: Unknown message, ignored")
 
@@ -142,36 +741,109 @@ class Display(Thread):
             print(f"{self.name}: Unknown mode: {mode}")
             return
 
-        self.mode = mode
-        self.mode_data = data
-
         expire = data.get('expire') # => None if not there
         if expire is None:
-            self.mode_expire = -1
+            expire = -1
         else:
-            self.mode_expire = time.time() + expire
+            expire = time.time() + expire
+
+        with self._state_lock:
+            self.state = self.state._replace(mode=mode, data=data, expire=expire, since=time.monotonic())
+
+    def expire_if(self, state):
+        """
+        Back to idle, but only if 'state' is still the current state.
+        A message set since the caller looked must not be lost.
+        """
+        with self._state_lock:
+            if self.state is not state:
+                return False
+            self.state = state._replace(mode=self.MODE_IDLE, data={}, expire=-1, since=time.monotonic())
+        print(f"{self.name}: Expired, set_mode={self.MODE_IDLE}")
+        return True
 
     def update_image(self, image):
-        self.image = image
+        # Normalise once here, not on every frame
+        image = self.driver.fit_image(image)
+        with self._state_lock:
+            # Frames for the old wallpaper are useless now
+            self.state = self.state._replace(image=image, frames={})
+        self.warm_frames()
 
-    def draw_clock(self, image, text_time):
-        # Draw into a new copy of the image
-        image_draw = image.copy()
-        draw = ImageDraw.Draw(image_draw)
-        bbox = draw.textbbox((0,0), text=text_time, font=self.font_time, stroke_width=1)
+    @staticmethod
+    def frame_key(payload):
+        if isinstance(payload, dict):
+            # 'expire' doesn't change what's on the screen
+            return tuple(sorted((k, v) for k, v in payload.items() if k != 'expire'))
+        return payload
+
+    def message_frame(self, state, show_text=True):
+        """
+        Return the composed frame for the state's message, from the cache if possible.
+        show_text=False is the "off" frame of blinking text.
+        """
+        key = (self.frame_key(state.data), show_text)
+        frame = state.frames.get(key)
+        if frame is None:
+            frame = self.draw_message(state.image, state.data, show_text)
+            if len(state.frames) < FRAME_CACHE_SIZE:
+                state.frames[key] = frame
+        return frame
+
+    def warm_frames(self):
+        """
+        Pre-render the frames for the preloaded payloads in the background
+        so that the first button press after a wallpaper change is fast.
+        """
+        if not self._preload:
+            return
+        Thread(name="DisplayWarmup", target=self._warm_frames, args=(self.state, list(self._preload)), daemon=True).start()
+
+    def _warm_frames(self, state, payloads):
+        for payload in payloads:
+            if state.frames is not self.state.frames:
+                # Wallpaper changed again, don't bother
+                return
+            key = (self.frame_key(payload), True)
+            if key not in state.frames and len(state.frames) < FRAME_CACHE_SIZE:
+                state.frames[key] = self.draw_message(state.image, payload)
+
+    @staticmethod
+    def canvas(image, out=None):
+        """
+        'image' copied into the 'out' frame buffer, or into a new image
+        """
+        if out is None:
+            return image.copy()
+        out.paste(image)
+        return out
+
+    def draw_clock(self, image, text_time, out=None):
+        with tracing.span("draw_clock"):
+            return self._draw_clock(image, text_time, out)
+
+    def _draw_clock(self, image, text_time, out=None):
+        # Draw into a copy of the image
+        image_draw = self.canvas(image, out)
+        sprite, bbox = self.text_cache.get(text_time, self.font_time, (255,255,255))
         width = bbox[2]-bbox[0]
         height = bbox[3]-bbox[1]
-        draw.text((image_draw.width/2 - width/2, image_draw.height - height - bbox[1] - 5), text_time, font=self.font_time, fill=(255,255,255), stroke_width=1, stroke_fill=(0,0,0))
+        self.text_cache.paste(image_draw, sprite, bbox, (image_draw.width/2 - width/2, image_draw.height - height - bbox[1] - 5))
         return image_draw
 
-    def draw_message(self, image, payload):
+    def message_style(self, payload):
+        """
+        Returns (text, color, subtext, subtext_color, blink)
+        """
         subtext = None
         subtext_color = None
+        blink = False
         if isinstance(payload, dict):
             text = payload.get('text', '??')
             color = payload.get('color', 'yellow')
             subtext = payload.get('subtext', None)
             subtext_color = payload.get('subtext_color', color)
+            blink = payload.get('blink', False)     # True or the period in seconds
         elif isinstance(payload, str):
             text = payload
             color = 'orange'
@@ -181,60 +853,193 @@ class Display(Thread):
             color = 'red'
         if subtext and not subtext_color:
             subtext_color = color
+        return text, color, subtext, subtext_color, blink
+
+    def draw_message(self, image, payload, show_text=True):
+        with tracing.span("draw_message"):
+            return self._draw_message(image, payload, show_text)
+
+    def _draw_message(self, image, payload, show_text=True):
+        text, color, subtext, subtext_color, blink = self.message_style(payload)
 
         # Draw into a new copy of the image
         image_draw = image.copy()
-        draw = ImageDraw.Draw(image_draw)
 
-        # Draw subtext - if any
+        # Draw subtext - if any. If it's too wide draw_marquee() scrolls it on top of this frame.
         subtext_height_occupied = 0
         if subtext:
-            subtext_bbox = draw.textbbox((0,0), text=subtext, font=self.font_subtext, stroke_width=1)
+            sprite, subtext_bbox = self.text_cache.get(subtext, self.font_subtext, subtext_color)
             subtext_width = subtext_bbox[2]-subtext_bbox[0]
             subtext_height = subtext_bbox[3]-subtext_bbox[1]
             subtext_height_occupied = subtext_height + subtext_bbox[1] + 5
-            draw.text((image_draw.width/2 - subtext_width/2, image_draw.height - subtext_height_occupied), subtext, font=self.font_subtext, fill=subtext_color, stroke_width=1, stroke_fill=(0,0,0))
+            if subtext_width <= image_draw.width:
+                self.text_cache.paste(image_draw, sprite, subtext_bbox, (image_draw.width/2 - subtext_width/2, image_draw.height - subtext_height_occupied))
 
         # Draw main text
-        text_bbox = draw.textbbox((0,0), text=text, font=self.font_text, stroke_width=1)
-        text_width = text_bbox[2]-text_bbox[0]
-        text_height = text_bbox[3]-text_bbox[1]
-        draw.text((image_draw.width/2 - text_width/2, (image_draw.height - subtext_height_occupied)/2 - text_height/2), text, font=self.font_text, fill=color, stroke_width=1, stroke_fill=(0,0,0))
+        if show_text:
+            sprite, text_bbox = self.text_cache.get(text, self.font_text, color)
+            text_width = text_bbox[2]-text_bbox[0]
+            text_height = text_bbox[3]-text_bbox[1]
+            self.text_cache.paste(image_draw, sprite, text_bbox, (image_draw.width/2 - text_width/2, (image_draw.height - subtext_height_occupied)/2 - text_height/2))
+
+        return image_draw
+
+    def draw_marquee(self, frame, payload, offset, out=None):
+        with tracing.span("draw_marquee"):
+            return self._draw_marquee(frame, payload, offset, out)
+
+    def _draw_marquee(self, frame, payload, offset, out=None):
+        """
+        Paste the subtext onto the composed 'frame' scrolled left by 'offset'
+        pixels. Only the subtext rows change from frame to frame so the
+        driver pushes just that strip over SPI.
+        """
+        text, color, subtext, subtext_color, blink = self.message_style(payload)
+        sprite, bbox = self.text_cache.get(subtext, self.font_subtext, subtext_color)
+        y = frame.height - (bbox[3] + 5)    # Same baseline as in _draw_message()
 
+        image_draw = self.canvas(frame, out)
+        x = -offset
+        while x < image_draw.width:
+            self.text_cache.paste(image_draw, sprite, bbox, (x - bbox[0], y))
+            x += sprite.width + MARQUEE_GAP
         return image_draw
 
 class ImageDownloader(Thread):
-    def __init__(self, messagebus, config):
+    def __init__(self, messagebus, config, store):
         super().__init__(name="ImageDownloader")
         self.enabled = config.get('enabled', True)
         self.refresh_period = config.get('refresh', WALLPAPER_CHANGE)    # Download a new image every this many seconds
         self.url = config['url']
+        self.max_size = config.get('max_size', DOWNLOAD_MAX_SIZE)
+        self.prefetch_count = config.get('prefetch', WALLPAPER_PREFETCH)
         self.messagebus = messagebus
+        self.store = store      # WallpaperStore
+
+        # One keep-alive session for all downloads. Imported here,
+        # it's slow to import and the panels come up before us.
+        import requests
+        self.session = requests.Session()
+        self.bytes_downloaded = 0
+        self._validators_url = None
+        self._validators = {}
+        self._new_validators = None     # From the last fetch(), until its image is stored
         if self.enabled:
             print(f"{self.name}: Refresh image every {self.refresh_period} sec from {self.url}")
 
     def run(self):
         print(f"Started ImageDownloader thread")
         start_ts = time.time()
+        # Display already shows the wallpaper restored from the store, keep it until the next refresh
+        show = self.store.current() is None
         while True:
             if self.enabled:
-                self.download_image()
+                if show:
+                    self.show_next()
+                self.prefetch()
+            show = True
             time.sleep(self.refresh_period - ((time.time() - start_ts) % self.refresh_period))
 
-    def download_image(self):
+    def show_next(self):
+        """
+        Publish the next wallpaper from the store, only touching
+        the network if the store has nothing new.
+        """
+        if not self.store.unseen():
+            self.prefetch(1)
+        path = None
         try:
-            r = requests.get(self.url)
-            print(f"{self.name}: {r.url}")
-            r.raise_for_status()
-            image = Image.open(BytesIO(r.content))
-            self.messagebus.publish("Display", "refresh", payload={"image": image})
+            # Moves the store's current image and saves its index, can fail e.g. on a full SD card
+            path = self.store.next()
+            if path is None:
+                return
+            image = Image.open(path)
+            image.load()
+            self.messagebus.publish("Display", "refresh", payload={"image": image, "path": path})
         except Exception as e:
-            print(f"{self.name}: {e}")
+            print(f"{self.name}: {path}: {e}")
+
+    def prefetch(self, count=None):
+        """
+        Download images into the store until it has 'count' unseen ones
+        """
+        if count is None:
+            count = self.prefetch_count
+        while self.store.unseen() < count:
+            self._new_validators = None
+            try:
+                downloaded = self.download_image()
+                if downloaded is None:
+                    # Nothing new on the server
+                    return
+                key, image, source = downloaded
+                # Writes the image and the index, can fail e.g. on a full SD card
+                added = self.store.add(key, fit_image(image, DISPLAY_WIDTH, DISPLAY_HEIGHT), source=source)
+            except Exception as e:
+                print(f"{self.name}: {e}")
+                return
+            if self._new_validators:
+                self._validators_url, self._validators = self._new_validators
+            if not added:
+                print(f"{self.name}: Already have {key}")
+                return
+
+    def fetch(self, url, conditional=False):
+        """
+        Stream 'url' into memory, giving up if it's bigger than max_size.
+        With conditional=True send the validators from the last response
+        and return None if the server says it hasn't changed.
+        """
+        headers = {}
+        if conditional and url == self._validators_url:
+            headers.update(self._validators)
+        with self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            print(f"{self.name}: {r.url} ({r.status_code})")
+            if r.status_code == 304:
+                return None
+            r.raise_for_status()
+            if int(r.headers.get('Content-Length', 0)) > self.max_size:
+                raise ValueError(f"Image too big: {r.headers['Content-Length']} bytes")
+            data = BytesIO()
+            for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                data.write(chunk)
+                if data.tell() > self.max_size:
+                    raise ValueError(f"Image too big: over {self.max_size} bytes")
+            self.bytes_downloaded += data.tell()
+
+            # Only sent with the next request once prefetch() has the image
+            # decoded and stored, a broken image must not be "not modified"
+            validators = {}
+            if 'ETag' in r.headers:
+                validators['If-None-Match'] = r.headers['ETag']
+            if 'Last-Modified' in r.headers:
+                validators['If-Modified-Since'] = r.headers['Last-Modified']
+            self._new_validators = (url, validators)
+        data.seek(0)
+        return data
+
+    def decode_image(self, data):
+        image = Image.open(data)
+        # JPEGs can decode straight at a fraction of the full resolution
+        image.draft("RGB", (DISPLAY_WIDTH, DISPLAY_HEIGHT))
+        image.load()
+        return image
+
+    def download_image(self):
+        """
+        Returns (key, image, source) or None if the image hasn't changed
+        """
+        data = self.fetch(self.url, conditional=True)
+        if data is None:
+            print(f"{self.name}: Image not modified")
+            return None
+        key = hashlib.sha1(data.getbuffer()).hexdigest()
+        return key, self.decode_image(data), self.url
 
 
 class UnsplashImageDownloader(ImageDownloader):
-    def __init__(self, messagebus, config):
-        super().__init__(messagebus, config)
+    def __init__(self, messagebus, config, store):
+        super().__init__(messagebus, config, store)
         self.api_key = config['api_key']
         self.width = DISPLAY_WIDTH
         self.height = DISPLAY_HEIGHT
@@ -243,16 +1048,13 @@ class UnsplashImageDownloader(ImageDownloader):
             print(f"{self.name}: Refresh image every {self.refresh_period} sec from Unsplash")
 
     def download_image(self):
-        try:
-            url = f"{self.url}?client_id={self.api_key}&orientation={self.orientation}"
-            r = requests.get(url)
-            print(f"{self.name}: Image metadata: {r.url}")
-            r.raise_for_status()
-            image_url = r.json()['urls']['raw']
-            image_url += f"&crop=faces,edges&fit=crop&w={self.width}&h={self.height}"
-            print(f"{self.name}: Image URL: {image_url}")
-            r = requests.get(image_url)
-            image = Image.open(BytesIO(r.content))
-            self.messagebus.publish("Display", "refresh", payload={"image": image})
-        except Exception as e:
-            print(f"{self.name}: {e}")
+        url = f"{self.url}?client_id={self.api_key}&orientation={self.orientation}"
+        r = self.session.get(url, timeout=DOWNLOAD_TIMEOUT)
+        print(f"{self.name}: Image metadata: {r.url}")
+        r.raise_for_status()
+        metadata = r.json()
+        image_url = metadata['urls']['raw']
+        image_url += f"&crop=faces,edges&fit=crop&w={self.width}&h={self.height}"
+        print(f"{self.name}: Image URL: {image_url}")
+        image = self.decode_image(self.fetch(image_url))
+        return metadata['id'], image, metadata.get('links', {}).get('html', image_url)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import contextlib
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Open a temp file next to 'path' and rename it to 'path' at the end
+    of the with block, so that a reader never sees a half written file
+    and a crash can't leave a broken one behind. On an exception 'path'
+    is left as it was. Each call gets a temp file of its own, writers
+    racing for the same 'path' don't trip over each other - the last
+    one to finish wins.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
@@ -1,13 +1,54 @@
-#!/usr/bin/env python3 
+#!/usr/bin/env python3
 
-import re
-import shlex
-import subprocess
+import time
+import fcntl
+import socket
+import struct
+from threading import Lock
+
+SIOCGIFADDR = 0x8915    # From <linux/sockios.h>
+IP_CACHE_TTL = 300      # Seconds
+
+def read_ip(device = "wlan0"):
+    """
+    Ask the kernel for the interface IPv4 address directly,
+    much cheaper than forking `ip addr show`.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', device[:15].encode('utf-8')))
+        except OSError:
+            # No such device or no address assigned
+            return "unknown"
+    return socket.inet_ntoa(ifreq[20:24])
+
+class IPCache:
+    """
+    Caches the interface address for 'ttl' seconds. Call invalidate()
+    when the network changes (e.g. on MQTT reconnect).
+    """
+    def __init__(self, device = "wlan0", ttl = IP_CACHE_TTL):
+        self.device = device
+        self.ttl = ttl
+        self._lock = Lock()
+        self._ip = None
+        self._expire = 0
+
+    def get(self):
+        with self._lock:
+            if self._ip is None or time.monotonic() >= self._expire:
+                self._ip = read_ip(self.device)
+                # Don't hold on to "unknown" for long, the address may be on its way
+                self._expire = time.monotonic() + (self.ttl if self._ip != "unknown" else min(self.ttl, 5))
+            return self._ip
+
+    def invalidate(self):
+        with self._lock:
+            self._ip = None
+
+_caches = {}
 
 def get_my_ip(device = "wlan0"):
-    cp = subprocess.run(shlex.split(f"ip addr show dev {device}"), stdout=subprocess.PIPE)
-    for line in cp.stdout.decode('utf-8').split("\n"):
-        m = re.match(' +inet ([^/]+)/', line)
-        if m:
-            return m.group(1)
-    return "unknown"
+    if device not in _caches:
+        _caches[device] = IPCache(device)
+    return _caches[device].get()
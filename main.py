@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
+import time
+START_TS = time.monotonic()
+
+import os
 import toml
+from concurrent.futures import ThreadPoolExecutor
 
-from button import Button
-from blinker import Blinker
-from buzzer import Buzzer
-from display import Display, UnsplashImageDownloader # , ImageDownloader
-from mqtt import MQTT
 from messagebus import messagebus
+import tracing
+import memstats
+
+# The component modules pull in heavy libraries (PIL, requests, paho,
+# gpiozero, the SPI driver) - they are imported in the start_*()
+# functions below so that the components can initialise in parallel.
 
 CONFIG_FILE = "config.toml"
 
@@ -17,21 +23,39 @@ BUTTON = "GPIO16"
 BUZZER = "GPIO3"
 
 class Controller:
-    def __init__(self, messagebus):
+    def __init__(self, messagebus, display="Display", topic=None, primary=True, snapshot=None):
+        """
+        display: bus component of the panel this Controller drives
+        topic: only react to MQTT messages from this topic, None = all
+        primary: the Controller that owns the Button, Blinker and Buzzer
+        snapshot: the panel's Snapshot, keeps the last payload across restarts
+        """
         self.messagebus = messagebus
         self.messagebus.subscribe(None, self.message_handler)   # None = subscribe to the root topic
-        self.last_mqtt_payload = ''
+        self.snapshot = snapshot
+        self.last_mqtt_payload = snapshot.state.get('payload', '') if snapshot else ''
+        self.display = display
+        self.topic = topic
+        self.primary = primary
+
+    def preload_display(self):
+        # Let the Display pre-render everything we may ask it to show
+        self.messagebus.publish(self.display, "preload", payload={
+            "messages": [self.mqtt_to_display(m) for m in ('yes', 'no', 'unknown')],
+        })
 
     def message_handler(self, component, message, **kwargs):
         print(f"Controller: component={component} message={message} kwargs={kwargs}")
-        if component == "Button":
+        if component == "Button" and self.primary:
             if message == "pressed":
                 self.messagebus.publish("Blinker", "fast", payload={"expire": 120}) # Expire fast-blinking after 2 mins at the latest
             elif message == "released":
-                self.messagebus.publish("Display", "display-message", payload=self.mqtt_to_display(self.last_mqtt_payload))
+                self.messagebus.publish(self.display, "display-message", payload=self.mqtt_to_display(self.last_mqtt_payload))
                 self.messagebus.publish("Buzzer", "play", payload={"tune": self.last_mqtt_payload})
                 self.messagebus.publish("Blinker", self.mqtt_to_color(self.last_mqtt_payload, default='fast'), payload={"expire": 30})
         elif component == "MQTT":
+            if self.topic and kwargs.get('topic') != self.topic:
+                return
             if message == "message" and 'payload' in kwargs:
                 # Sanitise MQTT Payload
                 payload = kwargs['payload'].lower()
@@ -39,10 +63,13 @@ class Controller:
                 if payload not in ('yes', 'no', 'unknown'):
                     print(f"Controller: Invalid MQTT payload: {payload}")
                     return
+                if self.snapshot and payload != self.last_mqtt_payload:
+                    self.snapshot.update(payload=payload)
                 self.last_mqtt_payload = payload
-                self.messagebus.publish("Display", "display-message", payload=self.mqtt_to_display(self.last_mqtt_payload))
-                self.messagebus.publish("Buzzer", "play", payload={"tune": self.last_mqtt_payload})
-                self.messagebus.publish("Blinker", self.mqtt_to_color(self.last_mqtt_payload, default='fast'), payload={"expire": 30})
+                self.messagebus.publish(self.display, "display-message", payload=self.mqtt_to_display(self.last_mqtt_payload))
+                if self.primary:
+                    self.messagebus.publish("Buzzer", "play", payload={"tune": self.last_mqtt_payload})
+                    self.messagebus.publish("Blinker", self.mqtt_to_color(self.last_mqtt_payload, default='fast'), payload={"expire": 30})
 
     def mqtt_to_color(self, mqtt_message, default=None):
         colormap = { "yes": "green", "no": "red" }
@@ -74,10 +101,29 @@ class Controller:
             "expire": 30,
         }
 
-if __name__ == "__main__":
-    print(f"Loading config from {CONFIG_FILE}")
-    with open(CONFIG_FILE) as f:
-        config = toml.load(f)
+class StartupTimer:
+    """
+    Reports how long it took from process start to the milestones
+    that components publish to the "Startup" topic.
+    """
+    def __init__(self, messagebus, start_ts):
+        self.start_ts = start_ts
+        self.marks = {}
+        messagebus.subscribe("Startup", self.message_handler)
+
+    def message_handler(self, component, message, payload={}):
+        self.mark(message)
+
+    def mark(self, name):
+        if name in self.marks:
+            return
+        self.marks[name] = time.monotonic() - self.start_ts
+        print(f"Startup: {name} after {self.marks[name]:.3f} sec")
+
+def start_gpio(config):
+    from button import Button
+    from blinker import Blinker
+    from buzzer import Buzzer
 
     print("Starting Blinker")
     blinker = Blinker(messagebus, LED1, LED2)
@@ -91,20 +137,153 @@ if __name__ == "__main__":
     buzzer = Buzzer(messagebus, BUZZER, config['Buzzer'])
     buzzer.start()
 
-    print("Creating Display")
-    display = Display(messagebus)
-    display.start()
+    return blinker, button, buzzer
+
+def panel_configs(config):
+    """
+    The [[Panel]] entries, or the one default panel showing the [MQTT] topic
+    """
+    return config.get('Panel') or [{'topic': config['MQTT']['topic']}]
+
+def panel_component(panel):
+    # Must match Display.component
+    return f"Display_{panel['name']}" if panel.get('name') else "Display"
+
+def panel_display_config(config, panel):
+    """
+    The [Display] options with the panel's own on top. With several
+    panels a png_path from [Display] gets the panel's component name
+    added, so that each panel saves its frames to a file of its own.
+    """
+    display_config = config.get('Display', {})
+    result = {**display_config, **panel}
+    if len(panel_configs(config)) > 1 and 'png_path' in display_config and 'png_path' not in panel:
+        root, ext = os.path.splitext(display_config['png_path'])
+        result['png_path'] = f"{root}-{panel_component(panel)}{ext}"
+    return result
+
+def open_panels(config):
+    """
+    Open the panels and put the frame from their last snapshot back
+    on them, before anything slow is initialised.
+    Returns [(driver, snapshot)] in panel_configs() order, snapshot
+    is None if disabled.
+    """
+    from display import DisplayDriver
+    from snapshot import Snapshot, SNAPSHOT_DIR
+
+    snapshot_config = config.get('Snapshot', {})
+    panels = []
+    for panel in panel_configs(config):
+        driver = DisplayDriver.from_config(panel_display_config(config, panel))
+        snapshot = None
+        if snapshot_config.get('enabled', True):
+            snapshot = Snapshot(os.path.join(snapshot_config.get('path', SNAPSHOT_DIR), f"{panel_component(panel)}.snapshot"))
+            if snapshot.restore(driver):
+                messagebus.publish("Startup", "snapshot-frame")
+        panels.append((driver, snapshot))
+    return panels
+
+def start_display(config, panels=None):
+    """
+    panels: from open_panels(), opened here if not given
+    """
+    from display import Display, TextCache, UnsplashImageDownloader, WALLPAPER, TEXT_CACHE_SIZE # , ImageDownloader
+    from wallpaper import WallpaperStore
+
+    if panels is None:
+        panels = open_panels(config)
+
+    # Local wallpaper cache, the last shown image is restored straight away
+    wallpapers = WallpaperStore(config.get('WallpaperStore', {}))
+
+    # All the panels share the wallpapers, fonts and rendered text
+    display_config = config.get('Display', {})
+    text_cache = TextCache(display_config.get('text_cache_size', TEXT_CACHE_SIZE))
+    displays = []
+    for panel, (driver, snapshot) in zip(panel_configs(config), panels):
+        wallpaper = snapshot.state.get('wallpaper') if snapshot else None
+        if not wallpaper or not os.path.exists(wallpaper):
+            wallpaper = wallpapers.current() or WALLPAPER
+        print(f"Creating Display {panel.get('name', '')}")
+        display = Display(messagebus, panel_display_config(config, panel), wallpaper=wallpaper,
+                          name=panel.get('name'), text_cache=text_cache, driver=driver, snapshot=snapshot)
+        display.start()
+        displays.append(display)
 
     # Start ImageDownloader background task
-    # image_downloader = ImageDownloader(messagebus, config['ImageDownloader'])
-    image_downloader = UnsplashImageDownloader(messagebus, config['UnsplashImageDownloader'])
+    # image_downloader = ImageDownloader(messagebus, config['ImageDownloader'], wallpapers)
+    image_downloader = UnsplashImageDownloader(messagebus, config['UnsplashImageDownloader'], wallpapers)
     image_downloader.start()
 
+    return displays, image_downloader
+
+def start_mqtt(config, client=None):
+    """
+    Not connected yet, see MQTT.connect()
+    """
+    from mqtt import MQTT
+
     print("Creating MQTT client")
-    mqtt = MQTT(messagebus, config['MQTT'])
+    topics = [panel['topic'] for panel in panel_configs(config)]
+    return MQTT(messagebus, config['MQTT'], client=client, topics=topics)
+
+if __name__ == "__main__":
+    print(f"Loading config from {CONFIG_FILE}")
+    with open(CONFIG_FILE) as f:
+        config = toml.load(f)
 
-    print("Creating Controller")
-    controller = Controller(messagebus)
+    # Must be set before the components subscribe
+    messagebus.asynchronous = config.get('MessageBus', {}).get('asynchronous', True)
+
+    startup_timer = StartupTimer(messagebus, START_TS)
+
+    # Dump the latency traces on SIGUSR1
+    tracing.install_signal_handler(config.get('Tracing', {}).get('file', tracing.TRACE_FILE))
+
+    # Dump the memory stats on SIGUSR2
+    memstats_config = config.get('MemStats', {})
+    if memstats_config.get('tracemalloc', False):
+        memstats.start_tracing()
+    memstats.install_signal_handler(memstats_config.get('file', memstats.MEMSTATS_FILE))
+
+    # Run without the Pi hardware and the MQTT broker
+    mqtt_client = None
+    if config.get('Simulator', {}).get('enabled', False):
+        import simulator
+        print("Using simulated hardware")
+        simulator.use_mock_gpio()
+        config.setdefault('Display', {})['backend'] = "framebuffer"
+        mqtt_client = simulator.FakeClient(simulator.FakeBroker(), config['MQTT'].get('client_name', ''))
+
+    # Show the last frame from before the restart while everything else starts up
+    opened_panels = open_panels(config)
+
+    # Controllers must be listening before the first MQTT message arrives.
+    # With a single panel it takes any MQTT message, as before.
+    print("Creating Controllers")
+    panels = panel_configs(config)
+    controllers = []
+    for i, (panel, (driver, snapshot)) in enumerate(zip(panels, opened_panels)):
+        controllers.append(Controller(messagebus, display=panel_component(panel),
+                                      topic=panel['topic'] if len(panels) > 1 else None, primary=(i == 0),
+                                      snapshot=snapshot))
     # controller.start()    # Controller is not a Thread
 
+    with ThreadPoolExecutor(thread_name_prefix="Startup") as pool:
+        mqtt_future = pool.submit(start_mqtt, config, mqtt_client)
+        display_future = pool.submit(start_display, config, opened_panels)
+        gpio_future = pool.submit(start_gpio, config)
+
+        mqtt = mqtt_future.result()
+        displays, image_downloader = display_future.result()
+        for controller in controllers:
+            controller.preload_display()
+        blinker, button, buzzer = gpio_future.result()
+
+    # The retained messages arrive straight away, the Display,
+    # Blinker and Buzzer must be listening by then
+    mqtt.connect()
+
+    startup_timer.mark("components-started")
     print("Startup done")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Memory usage report of the running process, dumped to a file on SIGUSR2:
+
+    kill -USR2 $(pidof -s python3)
+
+With tracemalloc enabled (see [MemStats] in config.toml) the report
+also lists the biggest allocation sites, at some CPU cost.
+"""
+
+import gc
+import sys
+import json
+import time
+import signal
+import threading
+import tracemalloc
+
+from fileutil import atomic_write
+
+MEMSTATS_FILE = "memstats.json"
+TOP_ALLOCATIONS = 25    # Allocation sites to list
+
+def rss():
+    """
+    Returns (resident set size, its peak) in bytes
+    """
+    sizes = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                sizes[key] = int(value.split()[0]) * 1024
+    return sizes.get("VmRSS", 0), sizes.get("VmHWM", 0)
+
+def traced():
+    """
+    Returns (current, peak) bytes allocated by Python code, zeros if tracemalloc is off
+    """
+    if not tracemalloc.is_tracing():
+        return 0, 0
+    return tracemalloc.get_traced_memory()
+
+def start_tracing(frames=1):
+    """
+    Start tracemalloc, 'frames' deep tracebacks per allocation
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def count_images():
+    # Leaked frames and wallpapers are the big ones, count what's alive
+    image_module = sys.modules.get("PIL.Image")
+    if image_module is None:
+        return 0, 0
+    count = size = 0
+    for obj in gc.get_objects():
+        if isinstance(obj, image_module.Image):
+            count += 1
+            if obj.mode:    # Images being created have none yet
+                size += obj.width * obj.height * len(obj.getbands())
+    return count, size
+
+def pillow_stats():
+    # Pillow's own block allocator, outside tracemalloc's view
+    image_module = sys.modules.get("PIL.Image")
+    if image_module is None:
+        return {}
+    return image_module.core.get_stats()
+
+def report():
+    rss_now, rss_peak = rss()
+    traced_now, traced_peak = traced()
+    images, images_bytes = count_images()
+    result = {
+        "time": time.time(),
+        "rss": rss_now,
+        "rss_peak": rss_peak,
+        "traced": traced_now,
+        "traced_peak": traced_peak,
+        "threads": threading.active_count(),
+        "gc_objects": len(gc.get_objects()),
+        "gc_counts": gc.get_count(),
+        "images": images,
+        "images_bytes": images_bytes,
+        "pillow": pillow_stats(),
+        "top_allocations": [],
+    }
+    if tracemalloc.is_tracing():
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            result["top_allocations"].append({
+                "site": f"{frame.filename}:{frame.lineno}",
+                "size": stat.size,
+                "count": stat.count,
+            })
+    return result
+
+def dump(path=MEMSTATS_FILE):
+    data = report()
+    with atomic_write(path) as f:
+        json.dump(data, f, indent=1)
+    print(f"MemStats: RSS {data['rss'] // 1024} kB, dumped to {path}")
+
+def install_signal_handler(path=MEMSTATS_FILE):
+    """
+    Dump the report to 'path' on SIGUSR2. Must be called from the main thread.
+    """
+    # Not from the handler itself, walking the heap can take a while
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(name="MemStats", target=dump, args=(path,), daemon=True).start())
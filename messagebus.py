@@ -1,7 +1,91 @@
 #!/usr/bin/env python3
 
+import time
+from functools import wraps
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+
 from pubsub import pub
 
+import tracing
+
+QUEUE_SIZE = 32     # Messages waiting per subscriber before we start dropping the oldest
+
+class Subscriber(Thread):
+    """
+    Runs one handler on its own thread, fed from its own bounded queue,
+    so that a slow handler (e.g. Buzzer playing a tune) doesn't block
+    the publisher or the other subscribers.
+    """
+    def __init__(self, topic, handler, queue_size=QUEUE_SIZE):
+        super().__init__(name=f"Subscriber-{topic}-{getattr(handler, '__qualname__', handler)}", daemon=True)
+        self.topic = topic
+        self.handler = handler
+        self.queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+
+        # Metrics
+        self.delivered = 0
+        self.dropped = 0
+        self.queue_max = 0
+        self.wait_max = 0.0         # Time spent in the queue
+        self.latency_total = 0.0    # Time spent in the handler
+        self.latency_max = 0.0
+
+        # pypubsub infers the topic arguments from the listener signature,
+        # wraps() makes our listener look like the real handler.
+        @wraps(handler)
+        def listener(**kwargs):
+            self.put(kwargs)
+        self.listener = listener
+
+    def put(self, kwargs):
+        # Runs in the publisher's thread - take its trace along
+        item = (time.monotonic(), tracing.current(), kwargs)
+        with self._lock:
+            try:
+                self.queue.put_nowait(item)
+            except Full:
+                # Newer messages supersede the older ones - drop the oldest
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+                self.queue.put_nowait(item)
+                self.dropped += 1
+                print(f"{self.name}: queue full, dropped oldest message")
+            self.queue_max = max(self.queue_max, self.queue.qsize())
+
+    def run(self):
+        while True:
+            queued_ts, trace_id, kwargs = self.queue.get()
+            start_ts = time.monotonic()
+            tracing.set_current(trace_id)
+            tracing.record(trace_id, f"queue {self.topic}", time.time() - (start_ts - queued_ts), start_ts - queued_ts)
+            try:
+                with tracing.span(f"handler {self.handler.__qualname__}"):
+                    self.handler(**kwargs)
+            except Exception as e:
+                print(f"{self.name}: {e}")
+            end_ts = time.monotonic()
+
+            self.delivered += 1
+            self.wait_max = max(self.wait_max, start_ts - queued_ts)
+            self.latency_total += end_ts - start_ts
+            self.latency_max = max(self.latency_max, end_ts - start_ts)
+
+    def stats(self):
+        return {
+            "topic": self.topic,
+            "queue_depth": self.queue.qsize(),
+            "queue_max": self.queue_max,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "wait_max": self.wait_max,
+            "latency_avg": self.latency_total / self.delivered if self.delivered else 0.0,
+            "latency_max": self.latency_max,
+        }
+
 class MessageBus:
     ROOT_TOPIC="root"
     _instance = None
@@ -10,6 +94,10 @@ class MessageBus:
         # Singleton initialisation
         if cls._instance is None:
             cls._instance = super(MessageBus, cls).__new__(cls)
+            # Deliver each subscriber's messages on its own thread.
+            # Set to False before subscribing to call handlers inline (e.g. for tests).
+            cls._instance.asynchronous = True
+            cls._instance.subscribers = []
             print("Created new MessageBus")
         return cls._instance
 
@@ -17,7 +105,14 @@ class MessageBus:
         topic = f"{self.ROOT_TOPIC}"
         if component:
             topic += f".{component}"
-        pub.subscribe(handler, topic)
+        if not self.asynchronous:
+            pub.subscribe(handler, topic)
+            return
+        subscriber = Subscriber(topic, handler)
+        # pubsub only keeps weak references, self.subscribers keeps them alive
+        self.subscribers.append(subscriber)
+        pub.subscribe(subscriber.listener, topic)
+        subscriber.start()
 
     def publish(self, component, message, **kwargs):
         topic = f"{self.ROOT_TOPIC}"
@@ -25,5 +120,8 @@ class MessageBus:
             topic += f".{component}"
         pub.sendMessage(topic, component=component, message=message, **kwargs)
 
+    def stats(self):
+        return [subscriber.stats() for subscriber in self.subscribers]
+
 messagebus = MessageBus()
 print("messagebus: {}".format(id(messagebus)))
@@ -1,48 +1,168 @@
 import json
+import time
 import datetime
+from threading import Thread, Condition, Lock, Timer
+from collections import OrderedDict
 import paho.mqtt.client
 import paho.mqtt.publish
 
-from iputil import get_my_ip
+import tracing
+from iputil import IPCache
+
+COALESCE_WINDOW = 0.5   # Seconds - pass on at most one message per window
+PUBLISH_QUEUE_SIZE = 16 # Topics waiting to be published before we start dropping
+
+class Publisher(Thread):
+    """
+    Publishes outgoing messages from its own thread so that the caller
+    (e.g. paho's network thread) never waits for JSON encoding or the
+    client. Only the latest message per topic is kept - for retained
+    status topics the intermediate values are of no use to anyone.
+    """
+    def __init__(self, client, queue_size=PUBLISH_QUEUE_SIZE):
+        super().__init__(name="MQTT-Publisher", daemon=True)
+        self.client = client
+        self.queue_size = queue_size
+        self._pending = OrderedDict()   # topic -> (data, qos, retain)
+        self._cond = Condition()
+
+        # Counters
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.published = 0
+        self.acked = 0
+
+    def publish(self, topic, data, qos=1, retain=True):
+        with self._cond:
+            self.queued += 1
+            if topic in self._pending:
+                self.coalesced += 1
+                del self._pending[topic]
+            elif len(self._pending) >= self.queue_size:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[topic] = (data, qos, retain)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                topic, (data, qos, retain) = self._pending.popitem(last=False)
+            if not isinstance(data, (str, bytes)):
+                data = json.dumps(data)
+            try:
+                self.client.publish(topic, data, qos=qos, retain=retain)
+                self.published += 1
+            except Exception as e:
+                print(f"{self.name}: {e}")
+
+    def on_publish(self, client, userdata, mid):
+        self.acked += 1
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "published": self.published,
+            "in_flight": self.published - self.acked,
+        }
 
 class MQTT:
-    def __init__(self, messagebus, config):
+    def __init__(self, messagebus, config, client=None, topics=None):
+        """
+        client: optional stand-in for paho.mqtt.client.Client, e.g. for testing
+        topics: subscribe to these instead of config['topic'], e.g. one per panel
+        """
         self.config = config
+        self.messagebus = messagebus
 
         self.server = config['server']
         self.port = config.get('port', 1883)
-        self.topic = config['topic']
+        self.topics = topics or [config['topic']]
         self.client_name = config.get('client_name', 'is-he-coming')
+        self.my_ip = IPCache(config.get('interface', 'wlan0'))
 
-        self.client = paho.mqtt.client.Client(self.client_name)
+        # Bursts of messages (retained replays, spam) are collapsed into
+        # the latest one so that we don't beep, blink and redraw for each.
+        self.coalesce_window = config.get('coalesce_window', COALESCE_WINDOW)
+        self._lock = Lock()
+        self._pending = OrderedDict()   # topic -> (payload, trace_id)
+        self._timer = None
+        self._last_flush = 0
+        self.received = 0
+        self.delivered = 0
+
+        self.client = client or paho.mqtt.client.Client(self.client_name)
         if config.get('username'):
             self.client.username_pw_set(config['username'], config.get('password'))
 
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.on_subscribe = self.on_subscribe
+
+        self.publisher = Publisher(self.client, config.get('publish_queue_size', PUBLISH_QUEUE_SIZE))
+        self.client.on_publish = self.publisher.on_publish
+        self.publisher.start()
 
         self.client.enable_logger()
+
+    def connect(self):
+        """
+        Connect and start delivering messages. Only once everything that
+        reacts to them is subscribed to the bus, the broker replays the
+        retained messages straight away.
+        """
         self.client.connect_async(self.server, port=self.port)
         self.client.loop_start()
 
-        self.messagebus = messagebus
-
     def publish(self, topic, data):
-        if not isinstance(data, (str, bytes)):
-            data = json.dumps(data)
-        self.client.publish(topic, data, qos=1, retain=True)
+        # Queued, encoded and sent by the Publisher thread
+        self.publisher.publish(topic, data, qos=1, retain=True)
 
     def on_connect(self, client, userdata, flags, rc):
         print(f"MQTT: Connected")
-        ret = client.subscribe(self.topic, 1)
-        print(f"MQTT: Subscribed to: {self.topic} ({ret})")
+        self.my_ip.invalidate()     # (Re)connected - the address may have changed
+        for topic in self.topics:
+            ret = client.subscribe(topic, 1)
+            print(f"MQTT: Subscribed to: {topic} ({ret})")
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self.messagebus.publish("Startup", "mqtt-subscribed")
 
     def on_message(self, client, userdata, msg):
         print(f"MQTT: {msg.topic}: {msg.payload}")
         payload = msg.payload.decode('ascii')
-        self.messagebus.publish("MQTT", "message", payload=payload)
-        self.publish(f"{msg.topic}/current", {
-            "payload": payload,
-            "timestamp": str(datetime.datetime.now().astimezone()),
-            "ip": get_my_ip(),
-        })
+        trace_id = tracing.start("mqtt-message")
+        with self._lock:
+            self.received += 1
+            self._pending[msg.topic] = (payload, trace_id)
+            if self._timer is None:
+                # First message since the last flush - deliver it as soon as the window allows
+                delay = max(0, self._last_flush + self.coalesce_window - time.monotonic())
+                self._timer = Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._timer = None
+            self._last_flush = time.monotonic()
+            self.delivered += len(pending)
+        # The latest message of each topic
+        for topic, (payload, trace_id) in pending.items():
+            tracing.set_current(trace_id)
+            self.messagebus.publish("MQTT", "message", payload=payload, topic=topic)
+            self.publish(f"{topic}/current", {
+                "payload": payload,
+                "timestamp": str(datetime.datetime.now().astimezone()),
+                "ip": self.my_ip.get(),
+            })
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Conversion of RGB frames to the big-endian RGB565 pixel data that
+the ST7735 takes, into one buffer that is reused for every frame.
+
+adafruit_rgb_display's image() converts through a Python list of
+ints (or pixel by pixel without numpy) on every SPI write. With numpy
+we do it with vectorised ops writing straight into our buffer. Without
+numpy Pillow does it with per-channel lookup tables, still all in C.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from PIL import Image, ImageChops
+
+# Lookup tables for the Pillow path, one output byte is the sum of two of them
+#   high byte: RRRRRGGG   low byte: GGGBBBBB
+LUT_HIGH_R = [v & 0xF8 for v in range(256)]
+LUT_HIGH_G = [v >> 5 for v in range(256)]
+LUT_LOW_G = [(v << 3) & 0xE0 for v in range(256)]
+LUT_LOW_B = [v >> 3 for v in range(256)]
+
+class RGB565Buffer:
+    """
+    Converts RGB images up to width x height pixels into a buffer
+    allocated once. convert() returns a memoryview of the buffer
+    that is only valid until the next convert().
+    """
+    def __init__(self, width, height):
+        self.buffer = bytearray(width * height * 2)
+        self._view = memoryview(self.buffer)
+        if numpy:
+            self._out = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+            self._tmp = numpy.empty(width * height, dtype=numpy.uint8)
+
+    def convert(self, image, rotation=0):
+        """
+        image: RGB image, no bigger than the buffer
+        rotation: degrees counter-clockwise, same as Image.rotate()
+        """
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        nbytes = image.width * image.height * 2
+        if nbytes > len(self.buffer):
+            raise ValueError(f"Image {image.width}x{image.height} doesn't fit the buffer")
+        if numpy:
+            self._convert_numpy(image, rotation)
+        else:
+            self._convert_pillow(image, rotation)
+        return self._view[:nbytes]
+
+    def _convert_numpy(self, image, rotation):
+        rgb = numpy.asarray(image)
+        if rotation:
+            # A view, the ops below read it in the rotated order
+            rgb = numpy.rot90(rgb, rotation // 90)
+        height, width = rgb.shape[:2]
+        out = self._out[:width * height * 2].reshape(height, width, 2)
+        tmp = self._tmp[:width * height].reshape(height, width)
+        high, low = out[..., 0], out[..., 1]
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+        numpy.bitwise_and(r, 0xF8, out=high)
+        numpy.right_shift(g, 5, out=tmp)
+        numpy.bitwise_or(high, tmp, out=high)
+
+        numpy.left_shift(g, 3, out=low)
+        numpy.bitwise_and(low, 0xE0, out=low)
+        numpy.right_shift(b, 3, out=tmp)
+        numpy.bitwise_or(low, tmp, out=low)
+
+    def _convert_pillow(self, image, rotation):
+        if rotation:
+            image = image.rotate(rotation, expand=True)
+        r, g, b = image.split()
+        # The bits don't overlap so add() works as bitwise or
+        high = ImageChops.add(r.point(LUT_HIGH_R), g.point(LUT_HIGH_G))
+        low = ImageChops.add(g.point(LUT_LOW_G), b.point(LUT_LOW_B))
+        # "LA" interleaves the two bytes of each pixel
+        data = Image.merge("LA", (high, low)).tobytes()
+        self._view[:len(data)] = data
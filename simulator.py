@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Hardware-free stand-ins for the Raspberry Pi peripherals, the MQTT
+broker and the image server, so that the whole component graph can
+run on any machine.
+"""
+
+import os
+import json
+import time
+import array
+import random
+from io import BytesIO
+from queue import Queue
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+from fileutil import atomic_write
+
+# CASET + RASET + RAMWR commands with their arguments, sent before each window
+SPI_WINDOW_OVERHEAD = 11
+
+class FramebufferPanel:
+    """
+    Stand-in for adafruit_rgb_display's ST7735 with the same image() and
+    _block() API. Keeps the picture in memory and counts the SPI bytes
+    the real panel would have received.
+    """
+    def __init__(self, width, height, rotation=0):
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.framebuffer = Image.new("RGB", (width, height))
+        self._lock = Lock()
+
+        self.windows = 0
+        self.bytes_sent = 0
+
+    def image(self, img, rotation=None, x=0, y=0):
+        if rotation is None:
+            rotation = self.rotation
+        if not img.mode in ("RGB", "RGBA"):
+            raise ValueError("Image must be in mode RGB or RGBA")
+        if rotation != 0:
+            img = img.rotate(rotation, expand=True)
+        if img.width + x > self.width or img.height + y > self.height:
+            raise ValueError(f"Image must not exceed dimensions of display ({self.width}x{self.height})")
+        self._paste(img, x, y)
+
+    def _block(self, x0, y0, x1, y1, data):
+        """
+        Write big-endian RGB565 pixel data to the x0, y0 - x1, y1 window (inclusive)
+        """
+        width, height = x1 - x0 + 1, y1 - y0 + 1
+        if len(data) != width * height * 2:
+            raise ValueError(f"Expected {width * height * 2} bytes, got {len(data)}")
+        # Pillow only decodes little-endian RGB565
+        pixels = array.array('H')
+        pixels.frombytes(data)
+        pixels.byteswap()
+        self._paste(Image.frombytes("RGB", (width, height), pixels, "raw", "BGR;16"), x0, y0)
+
+    def _paste(self, img, x, y):
+        with self._lock:
+            self.framebuffer.paste(img, (x, y))
+            self.windows += 1
+            self.bytes_sent += SPI_WINDOW_OVERHEAD + img.width * img.height * 2
+
+    def save(self, path):
+        """
+        Save what the panel shows, the right way up
+        """
+        with self._lock:
+            image = self.framebuffer.rotate(-self.rotation, expand=True) if self.rotation else self.framebuffer.copy()
+        with atomic_write(path, "wb") as f:
+            image.save(f, format="PNG")
+
+def use_mock_gpio():
+    """
+    Make gpiozero use mock pins. Must be called before any LED, Button
+    or TonalBuzzer is created. Returns the factory, its pin(n) method
+    gives access to the mock pins, e.g. to press a button.
+    """
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+    Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+    return Device.pin_factory
+
+def topic_matches(sub, topic):
+    """
+    MQTT topic filter matching with '+' and '#' wildcards
+    """
+    sub_parts = sub.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(sub_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+class FakeMessage:
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+class FakeBroker:
+    """
+    In-process MQTT broker for FakeClient instances. Keeps retained
+    messages and delivers to all matching subscriptions.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.clients = []
+        self.retained = {}
+        self.published = 0
+
+    def connect(self, client):
+        with self._lock:
+            self.clients.append(client)
+
+    def subscribe(self, client, topic, qos):
+        with self._lock:
+            retained = [(t, p) for t, p in self.retained.items() if topic_matches(topic, t)]
+        for t, p in retained:
+            client.deliver(FakeMessage(t, p, qos, retain=True))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self._lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = payload
+            receivers = [(c, qos) for c in self.clients for s in c.subscriptions if topic_matches(s, topic)]
+        for client, qos in receivers:
+            client.deliver(FakeMessage(topic, payload, qos))
+
+class FakeClient:
+    """
+    Stand-in for paho.mqtt.client.Client, as much of it as we use.
+    Callbacks run on the "network" thread started by loop_start(), like
+    with paho, and the time they take is recorded.
+    """
+    def __init__(self, broker, client_id=""):
+        self.broker = broker
+        self.client_id = client_id
+        self.subscriptions = []
+        self._queue = Queue()
+        self._mid = 0
+
+        self.on_connect = None
+        self.on_message = None
+        self.on_subscribe = None
+        self.on_publish = None
+
+        # Callback thread latency
+        self.callbacks = 0
+        self.callback_total = 0.0
+        self.callback_max = 0.0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def enable_logger(self, logger=None):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        self.broker.connect(self)
+        self._call('on_connect', {}, 0)
+
+    def loop_start(self):
+        Thread(name=f"FakeMQTT-{self.client_id}", target=self._loop, daemon=True).start()
+
+    def subscribe(self, topic, qos=0):
+        self._mid += 1
+        self.subscriptions.append(topic)
+        self._call('on_subscribe', self._mid, (qos,))
+        self.broker.subscribe(self, topic, qos)
+        return (0, self._mid)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid += 1
+        self.broker.publish(topic, payload, qos, retain)
+        self._call('on_publish', self._mid)
+        return (0, self._mid)
+
+    def deliver(self, msg):
+        self._call('on_message', msg)
+
+    def _call(self, callback, *args):
+        self._queue.put((callback, args))
+
+    def _loop(self):
+        while True:
+            callback, args = self._queue.get()
+            handler = getattr(self, callback)
+            if not handler:
+                continue
+            start_ts = time.monotonic()
+            try:
+                handler(self, None, *args)
+            except Exception as e:
+                print(f"FakeClient: {callback}: {e}")
+            elapsed = time.monotonic() - start_ts
+            self.callbacks += 1
+            self.callback_total += elapsed
+            self.callback_max = max(self.callback_max, elapsed)
+
+def random_jpeg(size):
+    data = BytesIO()
+    Image.effect_noise(size, random.randint(16, 128)).convert("RGB").save(data, format="JPEG")
+    return data.getvalue()
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the image servers, on a random port of 127.0.0.1:
+
+        /photos/random  Unsplash API metadata pointing at a new /image/<id>
+        /image/<id>     a new random JPEG on every request
+        /wallpaper.jpg  always the same JPEG, with an ETag and 304 replies
+        /broken.jpg     the same but not an image at all
+        /large/<bytes>  junk of that size, with Content-Length
+        /stream/<bytes> junk of that size, without Content-Length
+
+    Start serve_forever() on a thread of its own.
+    """
+    daemon_threads = True
+    STREAM_CHUNK = 64*1024
+
+    def __init__(self, image_size=(640, 480)):
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.image_size = image_size
+        self.wallpaper = random_jpeg(image_size)
+        self._lock = Lock()
+
+        # Counters
+        self.served = 0         # Images
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+    def count(self, served=0, not_modified=0, nbytes=0):
+        with self._lock:
+            self.served += served
+            self.not_modified += not_modified
+            self.bytes_sent += nbytes
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        if path == "/photos/random":
+            photo_id = f"sim-{random.getrandbits(64):016x}"
+            self.reply(json.dumps({
+                "id": photo_id,
+                "urls": {"raw": f"{server.url}/image/{photo_id}?fm=jpg"},
+                "links": {"html": f"{server.url}/photo/{photo_id}"},
+            }).encode('utf-8'), "application/json")
+        elif path.startswith("/image/"):
+            self.reply(random_jpeg(server.image_size), "image/jpeg")
+            server.count(served=1)
+        elif path in ("/wallpaper.jpg", "/broken.jpg"):
+            etag = f'"{path[1:]}-1"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                server.count(not_modified=1)
+                return
+            body = server.wallpaper if path == "/wallpaper.jpg" else b"Not a JPEG"
+            self.reply(body, "image/jpeg", {"ETag": etag})
+            server.count(served=1)
+        elif path.startswith("/large/"):
+            self.stream(int(path[len("/large/"):]), content_length=True)
+        elif path.startswith("/stream/"):
+            self.stream(int(path[len("/stream/"):]), content_length=False)
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+            self.server.count(nbytes=len(body))
+        except ConnectionError:
+            pass    # The client gave up, e.g. on a too big download
+
+    def stream(self, nbytes, content_length):
+        # In chunks, the server runs in the process being measured.
+        # Without Content-Length the client only finds out how big it is as it reads.
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        if content_length:
+            self.send_header("Content-Length", str(nbytes))
+        self.end_headers()
+        self.close_connection = True
+        chunk = os.urandom(self.server.STREAM_CHUNK)
+        try:
+            while nbytes > 0:
+                self.wfile.write(chunk[:nbytes])
+                self.server.count(nbytes=min(nbytes, len(chunk)))
+                nbytes -= len(chunk)
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
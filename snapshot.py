@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Last known state of a panel, saved so that after a restart the right
+picture is back on the panel straight away, before the fonts, the
+network and the rest of the components are up.
+
+The file is a small JSON header followed by the last frame as raw
+RGB565 in the panel's own orientation, ready to go over SPI as is:
+
+    MAGIC | header length (4 bytes, big-endian) | header | frame
+"""
+
+import os
+import json
+import mmap
+import time
+import struct
+from threading import Lock
+
+from fileutil import atomic_write
+
+MAGIC = b"CDS1"
+SNAPSHOT_DIR = "cache/snapshots"
+
+class Snapshot:
+    """
+    'state' holds what the components saved: the Controller's last
+    payload, the Display mode, data and expiry and the wallpaper path.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._frame = b''
+        self._lock = Lock()     # Display and Controller update it from their own threads
+
+    def restore(self, driver):
+        """
+        Load the snapshot and push its frame straight from the file to
+        the panel. Returns True if there was a frame worth showing.
+        """
+        try:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(MAGIC)] != MAGIC:
+                    raise ValueError("Not a snapshot")
+                header_len, = struct.unpack_from(">I", mm, len(MAGIC))
+                offset = len(MAGIC) + 4
+                self.state = json.loads(mm[offset:offset + header_len])
+                with memoryview(mm) as view:
+                    frame = view[offset + header_len:]
+                    self._frame = bytes(frame)
+                    # A message that has expired in the meantime isn't worth showing
+                    if not frame or 0 < self.state.get('expire', -1) <= time.time():
+                        frame.release()
+                        return False
+                    driver.display_rgb565(frame)
+                    frame.release()
+            print(f"Snapshot: Restored {self.path}")
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Snapshot: Ignoring {self.path}: {e}")
+            self.state = {}
+            return False
+
+    def update(self, frame=None, **state):
+        """
+        Merge 'state' into the snapshot, replace the frame if given
+        (raw RGB565 from DisplayDriver.frame_rgb565()) and write it out.
+        """
+        with self._lock:
+            self.state.update(state)
+            if frame is not None:
+                self._frame = bytes(frame)
+            header = json.dumps(self.state).encode('utf-8')
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with atomic_write(self.path, "wb") as f:
+                f.write(MAGIC + struct.pack(">I", len(header)) + header)
+                f.write(self._frame)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Soak test: runs the whole component graph on simulated hardware (see
+benchmark.py and simulator.py) through hours of accelerated time and
+fails if the memory use grows past a budget.
+
+Wallpapers are downloaded from a local HTTP server by the real
+downloader, MQTT messages go through the fake broker and the button
+is pressed on its mock pin, all 'speedup' times more often than in a
+busy day of real use. RSS and the memory traced by tracemalloc are
+sampled along the way. The baseline is the sample at the end of a
+warm-up, long enough for the wallpaper store and the caches to fill,
+and the test fails if the memory use grows past the budget over it.
+
+    python3 soak.py [-v] [--hours 24] [--speedup 600] [--warmup 2] [--budget-mb 8]
+"""
+
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+from gpiozero import Device
+
+import memstats
+from benchmark import Bench, TOPIC
+from simulator import ImageServer
+from display import WALLPAPER_CHANGE
+
+# Events per simulated hour
+MQTT_PER_HOUR = 120
+PRESSES_PER_HOUR = 30
+
+SAMPLE_INTERVAL = 1.0   # Seconds, real time
+WARMUP = 2              # Simulated hours before the baseline is taken
+BUDGET_MB = 8           # Allowed growth of RSS and traced memory over the baseline
+
+def press(pin):
+    pin.drive_low()
+    time.sleep(0.05)
+    pin.drive_high()
+
+def soak(bench, duration, speedup, warmup, progress):
+    """
+    Drive the components for 'duration' real seconds, the first 'warmup' of them to warm up.
+    Returns the memory samples as (seconds, rss, traced) and the
+    tracemalloc snapshot taken at the baseline.
+    """
+    pin = bench.button.button.pin
+    samples = []
+    baseline_snapshot = None
+    mqtt_sent = presses = 0
+    start_ts = time.monotonic()
+    next_sample = start_ts
+    while True:
+        now = time.monotonic()
+        elapsed = now - start_ts
+        if elapsed >= duration:
+            break
+        hours = elapsed * speedup / 3600
+
+        while mqtt_sent < hours * MQTT_PER_HOUR:
+            bench.broker.publish(TOPIC, random.choice(("yes", "no", "unknown", "true", "bogus")), qos=1, retain=True)
+            mqtt_sent += 1
+        while presses < hours * PRESSES_PER_HOUR:
+            # Off the loop, a press takes a while
+            threading.Thread(name="SoakPress", target=press, args=(pin,), daemon=True).start()
+            presses += 1
+
+        if now >= next_sample:
+            # Mock pins record every state change, real ones don't
+            for mock_pin in Device.pin_factory.pins.values():
+                mock_pin.clear_states()
+            if baseline_snapshot is None and elapsed >= warmup:
+                # Before the baseline sample: the snapshot is kept until the
+                # report and takes several MB that tracemalloc doesn't see
+                baseline_snapshot = tracemalloc.take_snapshot()
+            rss, _ = memstats.rss()
+            traced, _ = memstats.traced()
+            samples.append((elapsed, rss, traced))
+            progress(f"{hours:6.1f} h  RSS {rss / 2**20:7.1f} MB  traced {traced / 2**20:7.1f} MB  "
+                     f"frames {bench.driver.frames}  wallpapers {bench.image_downloader.store.unseen()} unseen")
+            next_sample += SAMPLE_INTERVAL
+        time.sleep(0.01)
+    return samples, baseline_snapshot
+
+def growth(samples, column, warmup_end):
+    """
+    Growth from the baseline, the first sample after the warm-up, to the highest one after it
+    """
+    after = [sample[column] for sample in samples if sample[0] >= warmup_end]
+    if not after:
+        return 0
+    return max(after) - after[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak test on simulated hardware")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the components' output")
+    parser.add_argument("--hours", type=float, default=24, help="simulated hours to run for")
+    parser.add_argument("--speedup", type=float, default=600, help="simulated seconds per real second")
+    parser.add_argument("--warmup", type=float, default=WARMUP, help="simulated hours before the baseline is taken")
+    parser.add_argument("--budget-mb", type=float, default=BUDGET_MB, help="allowed memory growth over the baseline")
+    args = parser.parse_args()
+    if args.warmup >= args.hours:
+        sys.exit("The warm-up must be shorter than the run")
+
+    duration = args.hours * 3600 / args.speedup
+    warmup = args.warmup * 3600 / args.speedup
+    budget = args.budget_mb * 2**20
+    # The components are chatty and keep printing after we're done, only we write here
+    out = sys.stdout
+    out.write(f"Soaking {args.hours:g} h at {args.speedup:g}x, {duration:.0f} s, budget {args.budget_mb:g} MB\n")
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    tracemalloc.start()
+    server = ImageServer()
+    threading.Thread(name="ImageServer", target=server.serve_forever, daemon=True).start()
+
+    # Not a TemporaryDirectory, the downloader may still be writing to it when we remove it at the end
+    wallpaper_dir = tempfile.mkdtemp(prefix="soak-")
+    bench = Bench(wallpaper_dir, {
+        'UnsplashImageDownloader': {
+            'enabled': True,
+            'url': f"{server.url}/photos/random",
+            'api_key': "soak",
+            'refresh': WALLPAPER_CHANGE / args.speedup,
+        },
+    })
+    # Bench keeps every frame's timestamp, that would look like a leak
+    bench.driver.on_frame = None
+    progress = lambda line: print(line, file=out, flush=True)
+    samples, baseline_snapshot = soak(bench, duration, args.speedup, warmup, progress)
+    report = memstats.report()
+
+    rss_growth = growth(samples, 1, warmup)
+    traced_growth = growth(samples, 2, warmup)
+    print("== soak", file=out)
+    print(f"   {bench.driver.frames} frames, {server.served} wallpapers downloaded ({bench.image_downloader.bytes_downloaded / 2**20:.1f} MB), {bench.broker.published} MQTT messages", file=out)
+    print(f"   RSS {report['rss'] / 2**20:.1f} MB (peak {report['rss_peak'] / 2**20:.1f} MB), growth over the baseline {rss_growth / 2**20:.2f} MB", file=out)
+    print(f"   traced {report['traced'] / 2**20:.1f} MB, growth over the baseline {traced_growth / 2**20:.2f} MB", file=out)
+    print(f"   {report['images']} images alive ({report['images_bytes'] / 2**20:.1f} MB), {report['threads']} threads", file=out)
+    if baseline_snapshot:
+        print("   biggest growth since the baseline:", file=out)
+        for stat in tracemalloc.take_snapshot().compare_to(baseline_snapshot, "lineno")[:10]:
+            print(f"      {stat.size_diff / 1024:+9.1f} kB  {stat.traceback[0]}", file=out)
+
+    failed = rss_growth > budget or traced_growth > budget
+    print("FAIL: memory grew past the budget" if failed else "PASS", file=out)
+    out.flush()
+    shutil.rmtree(wallpaper_dir, ignore_errors=True)
+    # The component threads run forever, don't wait for them
+    os._exit(1 if failed else 0)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Lightweight latency tracing from an input (MQTT message, button press)
+through the message bus to the SPI push.
+
+An input starts a trace, the trace ID follows the messages across the
+bus threads and each interesting step records a timed span. The spans
+are kept in a ring buffer that is dumped to a file on SIGUSR1:
+
+    kill -USR1 $(pidof -s python3)
+"""
+
+import json
+import time
+import signal
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from fileutil import atomic_write
+
+TRACE_BUFFER = 2000             # Spans to keep
+TRACE_FILE = "trace.json"
+
+_local = threading.local()
+_ids = itertools.count(1)
+_spans = deque(maxlen=TRACE_BUFFER)
+
+def start(name):
+    """
+    Start a new trace in the current thread and return its ID
+    """
+    trace_id = next(_ids)
+    _local.trace_id = trace_id
+    record(trace_id, name, time.time(), 0.0)
+    return trace_id
+
+def current():
+    return getattr(_local, 'trace_id', None)
+
+def set_current(trace_id):
+    _local.trace_id = trace_id
+
+def record(trace_id, name, start_ts, duration):
+    if trace_id is None:
+        return
+    _spans.append((trace_id, name, threading.current_thread().name, start_ts, duration))
+
+@contextmanager
+def span(name, trace_id=None):
+    """
+    Time the 'with' block as a span of the current (or given) trace.
+    Does nothing outside of a trace.
+    """
+    if trace_id is None:
+        trace_id = current()
+    start_ts = time.time()
+    start_mono = time.monotonic()
+    try:
+        yield
+    finally:
+        record(trace_id, name, start_ts, time.monotonic() - start_mono)
+
+def traces():
+    """
+    The buffered spans grouped by trace, with the end-to-end latency
+    from the start of the trace to the end of its last span.
+    """
+    result = {}
+    for trace_id, name, thread, start_ts, duration in list(_spans):
+        trace = result.setdefault(trace_id, {"trace": trace_id, "start": start_ts, "end": start_ts, "spans": []})
+        trace['start'] = min(trace['start'], start_ts)
+        trace['end'] = max(trace['end'], start_ts + duration)
+        trace['spans'].append({
+            "name": name,
+            "thread": thread,
+            "offset": start_ts,
+            "duration": duration,
+        })
+    for trace in result.values():
+        trace['latency'] = trace['end'] - trace['start']
+        for s in trace['spans']:
+            s['offset'] -= trace['start']
+    return list(result.values())
+
+def dump(path=TRACE_FILE):
+    with atomic_write(path) as f:
+        json.dump(traces(), f, indent=1)
+    print(f"Tracing: Dumped {len(_spans)} spans to {path}")
+
+def install_signal_handler(path=TRACE_FILE):
+    """
+    Dump the traces to 'path' on SIGUSR1. Must be called from the main thread.
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump(path))
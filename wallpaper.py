@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+
+from PIL import Image
+
+import tracing
+from fileutil import atomic_write
+
+WALLPAPER_DIR = "cache/wallpapers"
+WALLPAPER_MAX_IMAGES = 50
+WALLPAPER_MAX_BYTES = 10*1024*1024
+WALLPAPER_PREFETCH = 3  # Unseen images to keep in stock
+INDEX_FILE = "index.json"
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]+")    # Keys become file names
+
+def fit_image(image, width, height):
+    """
+    Scale and center-crop 'image' to exactly fill width x height
+    and convert it to RGB.
+    """
+    with tracing.span("resize"):
+        return _fit_image(image, width, height)
+
+def _fit_image(image, width, height):
+    if image.size != (width, height):
+        print(f"Resizing from {image.width}x{image.height} to {width}x{height}")
+        image_ratio = image.width / image.height
+        screen_ratio = width / height
+        if screen_ratio > image_ratio:
+            scaled_width = width
+            scaled_height = image.height * width // image.width
+        else:
+            scaled_width = image.width * height // image.height
+            scaled_height = height
+        # Let JPEGs decode at a reduced scale, it's much faster than resampling
+        image.draft("RGB", (scaled_width, scaled_height))
+        image = image.resize((scaled_width, scaled_height), Image.BICUBIC)
+
+        # Center the image
+        x = image.width // 2 - width // 2
+        y = image.height // 2 - height // 2
+        image = image.crop((x, y, x + width, y + height))
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+class WallpaperStore:
+    """
+    Directory of panel-sized wallpapers with a JSON index.
+
+    Downloaded images are added as 'unseen' and next() hands them out
+    oldest first. When there is nothing new (e.g. the network is down)
+    next() rotates through the already seen ones, least recently used
+    first. The store is capped by number of images and total bytes,
+    evicting the least recently used seen images.
+    """
+    def __init__(self, config={}):
+        self.path = config.get('path', WALLPAPER_DIR)
+        self.max_images = config.get('max_images', WALLPAPER_MAX_IMAGES)
+        self.max_bytes = config.get('max_bytes', WALLPAPER_MAX_BYTES)
+        self.index_path = os.path.join(self.path, INDEX_FILE)
+
+        os.makedirs(self.path, exist_ok=True)
+        self.images = {}    # name -> {"size", "added", "used", "source"}
+        self._current = None
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.images = index['images']
+            self._current = index.get('current')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"WallpaperStore: Ignoring broken index: {e}")
+
+        # Forget about images that have gone missing
+        for name in list(self.images):
+            if not os.path.exists(os.path.join(self.path, name)):
+                del self.images[name]
+        print(f"WallpaperStore: {len(self.images)} images in {self.path}")
+
+    def add(self, key, image, source=None):
+        """
+        Store a panel-sized 'image' under 'key' (e.g. hash of the download).
+        Returns False if we already have it.
+        """
+        # Keys can come from the network (Unsplash photo IDs), keep them inside our directory
+        if not KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid key: {key!r}")
+        name = f"{key}.png"
+        if name in self.images:
+            return False
+        self._write(name, lambda f: image.save(f, format="PNG"))
+        self.images[name] = {
+            "size": os.path.getsize(os.path.join(self.path, name)),
+            "added": time.time(),
+            "used": 0,
+            "source": source,
+        }
+        self._evict()
+        self._save_index()
+        return True
+
+    def unseen(self):
+        return sum(1 for info in self.images.values() if not info['used'])
+
+    def next(self):
+        """
+        Pick the next wallpaper to show and return its path, or None if the store is empty
+        """
+        unseen = [name for name, info in self.images.items() if not info['used']]
+        if unseen:
+            name = min(unseen, key=lambda name: self.images[name]['added'])
+        else:
+            others = [name for name in self.images if name != self._current]
+            if not others:
+                return self.current()
+            name = min(others, key=lambda name: self.images[name]['used'])
+        self.images[name]['used'] = time.time()
+        self._current = name
+        self._save_index()
+        return os.path.join(self.path, name)
+
+    def current(self):
+        """
+        Path of the wallpaper shown last, survives restarts
+        """
+        if self._current not in self.images:
+            return None
+        return os.path.join(self.path, self._current)
+
+    def _evict(self):
+        def total_bytes():
+            return sum(info['size'] for info in self.images.values())
+        while len(self.images) > self.max_images or total_bytes() > self.max_bytes:
+            # Seen before unseen, least recently used first, never the current one
+            candidates = [name for name in self.images if name != self._current]
+            if not candidates:
+                break
+            name = min(candidates, key=lambda name: (self.images[name]['used'] == 0, self.images[name]['used'], self.images[name]['added']))
+            del self.images[name]
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def _save_index(self):
+        data = json.dumps({"images": self.images, "current": self._current}, indent=1)
+        self._write(INDEX_FILE, lambda f: f.write(data.encode('utf-8')))
+
+    def _write(self, name, writer):
+        with atomic_write(os.path.join(self.path, name), "wb") as f:
+            writer(f)